@@ -17,10 +17,17 @@
 An example HNCP transport using tool. Not for serious usage, as it is
 mostly copied from babeld.py (which while working, is not 'great').
 
+With --watch, it stays attached (read-only) and writes the changes
+as they are decoded as JSON lines instead: node add/remove, TLV
+add/remove (optionally only of the given TLV types), and seqno bumps.
+
 """
 
+import sys
+
 from pysyma.dncp import HNCP, Subscriber
 from pysyma.si import HNCPSystemInterface
+from pysyma.watch import WatchSubscriber
 
 import logging
 _logger = logging.getLogger(__name__)
@@ -30,18 +37,28 @@ if __name__ == '__main__':
     import argparse
     import logging
     ap = argparse.ArgumentParser()
-    ap.add_argument('-t', '--timeout', default=3, type=int, help='Timeout (seconds)')
+    ap.add_argument('-t', '--timeout', type=int,
+                    help='Timeout (seconds; default 3, none with --watch)')
     ap.add_argument('-w', '--write', action='store_true', help='Use write-enabled mode')
     ap.add_argument('-d', '--debug', action='store_true', help='Enable debugging')
+    ap.add_argument('--watch', action='store_true',
+                    help='Stay attached, and write changes as JSON lines')
+    ap.add_argument('--type', type=int, action='append', dest='types',
+                    help='With --watch, only show TLVs of this type (may be repeated)')
     ap.add_argument('ifname',
                     nargs='*',
                     help="Interfaces to listen on.")
     args = ap.parse_args()
-    si = HNCPSystemInterface()
-    hncp = si.create_dncp(HNCP, if_list=args.ifname, read_only=not args.write)
     if args.debug:
         import logging
         logging.basicConfig(level=logging.DEBUG)
+    si = HNCPSystemInterface()
+    if args.watch:
+        hncp = si.create_dncp(HNCP, if_list=args.ifname, read_only=True)
+        hncp.add_subscriber(WatchSubscriber(tlv_types=args.types))
+        si.loop(max_duration=args.timeout)
+        sys.exit(0)
+    hncp = si.create_dncp(HNCP, if_list=args.ifname, read_only=not args.write)
     result = [False]
     class HNCPSubscriber(Subscriber):
         def network_consistent_event(self, c):
@@ -49,7 +66,10 @@ if __name__ == '__main__':
                 si.running = False
                 result[0] = True
     hncp.add_subscriber(HNCPSubscriber())
-    si.loop(max_duration=args.timeout)
+    timeout = args.timeout
+    if timeout is None:
+        timeout = 3
+    si.loop(max_duration=timeout)
     assert result[0]
     for n in hncp.valid_sorted_nodes():
         print(n)
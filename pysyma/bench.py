@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- Python -*-
+#
+# $Id: bench.py $
+#
+# Author: Markus Stenberg <fingon@iki.fi>
+#
+# Copyright (c) 2026 Markus Stenberg
+#
+# Created:       Sat Oct 17 18:02:11 2026 mstenber
+# Last modified: Sat Oct 17 18:02:11 2026 mstenber
+# Edit time:     0 min
+#
+"""
+
+Micro-benchmarks for the codec and friends.
+
+Usage: python -m pysyma.bench [-o results.json] [codec] [encode] [hash] [memory]
+
+codec: ns/op and allocated bytes/op (peak, as seen by tracemalloc) of
+the TLV codec and SHSP encoding across TLV counts and body sizes. Use
+-o to store the results as JSON, so that they can be diffed between
+releases.
+
+hash: throughput of the profile hash algorithms (node and network
+hashes) and the SHSPAuth hash variants across data sizes.
+
+encode: the interesting number is ns/TLV; if it stays (roughly) flat
+as the TLV count grows, encoding is linear.
+
+memory: per-TLV memory use of decoded TLVs, compared to what the same
+attributes would cost in a per-instance __dict__ (which is what the
+TLV classes used to have).
+
+"""
+
+import json
+import time
+import tracemalloc
+
+from pysyma.dncp_tlv import PadBodyTLV, NodeState, Neighbor, NodeEP
+from pysyma.dncp_tlv import ReqNetState, encode_tlvs, decode_tlvs
+from pysyma.dncp import PROFILE_HASHES
+from pysyma.shsp import SHSPKV, SHSPAuth
+
+MIN_TIME = 0.2 # seconds each measurement is repeated for (at least)
+
+_MAX_BODY = 65535 # larger bodies do not fit in a (container) TLV
+
+
+def _time_per_call(fun, min_time=MIN_TIME):
+    n = 1
+    while True:
+        st = time.time()
+        for i in range(n):
+            fun()
+        dt = time.time() - st
+        if dt >= min_time:
+            return dt / n
+        n *= 2
+
+
+def _alloc_per_call(fun):
+    fun() # warm up caches
+    tracemalloc.start()
+    try:
+        st = tracemalloc.get_traced_memory()[0]
+        fun()
+        return tracemalloc.get_traced_memory()[1] - st
+    finally:
+        tracemalloc.stop()
+
+
+def _codec_cases(count, size):
+    body = b'x' * size
+    l = [PadBodyTLV(t=42, body=body + str(i).encode()) for i in range(count)]
+    b = encode_tlvs(*l)
+    yield 'encode_tlvs', lambda: encode_tlvs(*l)
+    yield 'decode_tlvs', lambda: list(decode_tlvs(b))
+    # Encodings are cached, so this is the comparison cost only
+    rl = l[::-1]
+    yield 'blob_sort', lambda: sorted(rl)
+    c = [PadBodyTLV(t=42, body=body + str(i).encode()) for i in range(count)]
+    yield 'blob_eq', lambda: l == c
+    # Leaves have their encoding cached; containers are built fresh
+    nl = [l[i:i+10] for i in range(0, count, 10)]
+    if len(b) + 12 * len(nl) < _MAX_BODY:
+        yield 'container_encode', lambda: ReqNetState(tlvs=[NodeEP(node_id=b'foob', ep_id=i, tlvs=x) for i, x in enumerate(nl)]).encode()
+    jl = [dict(k='key%d' % i, v=body.decode(), ts=i) for i in range(count)]
+    yield 'shspkv_encode', lambda: [SHSPKV(json=d).encode() for d in jl]
+    jb = encode_tlvs(*[SHSPKV(json=d) for d in jl])
+    yield 'shspkv_decode', lambda: list(decode_tlvs(jb))
+    if len(jb) < _MAX_BODY:
+        a = SHSPAuth(tlvs=list(decode_tlvs(jb)))
+        a.get_body()
+        yield 'shspauth_hash', a.body_encoded
+
+
+def bench_codec(counts=(1, 10, 100, 1000), sizes=(0, 16, 256),
+                min_time=MIN_TIME):
+    # SHSPAuth hashing needs the (class-wide) key
+    okey = getattr(SHSPAuth, 'key', None)
+    SHSPAuth.key = b'bench'
+    try:
+        for count in counts:
+            for size in sizes:
+                for name, fun in _codec_cases(count, size):
+                    dt = _time_per_call(fun, min_time)
+                    yield dict(name=name, count=count, size=size,
+                               ns_per_op=dt * 1e9,
+                               alloc_bytes_per_op=_alloc_per_call(fun))
+    finally:
+        if okey is None:
+            del SHSPAuth.key
+        else:
+            SHSPAuth.key = okey
+
+
+def bench_hash(sizes=(64, 1024, 16384, 65536), min_time=MIN_TIME):
+    for size in sizes:
+        b = b'x' * size
+        cases = [('%s/8' % name, lambda f=f: f(b, 8))
+                 for name, f in sorted(PROFILE_HASHES.items())]
+        for algorithm in ['md5', 'blake2b']:
+            # Subclass, so the class-wide key is left alone
+            cl = type('BenchSHSPAuth', (SHSPAuth,), dict(key=b'k' * 16))
+            a = cl(body=b, algorithm=algorithm)
+            cases.append(('shspauth-%s' % algorithm, a.get_hash))
+        for name, fun in cases:
+            dt = _time_per_call(fun, min_time)
+            yield dict(name=name, size=size, ns_per_op=dt * 1e9,
+                       mb_per_s=size / dt / 1e6)
+
+
+def bench_encode(counts=(10, 100, 1000, 10000, 100000)):
+    for count in counts:
+        l = [PadBodyTLV(t=42, body=b'x' * (i % 7)) for i in range(count)]
+        dt = _time_per_call(lambda: encode_tlvs(*l))
+        yield dict(count=count, ns_per_op=dt * 1e9, ns_per_tlv=dt * 1e9 / count)
+
+
+class _DictTLV:
+    pass
+
+
+def _traced_size(fun):
+    tracemalloc.start()
+    try:
+        st = tracemalloc.get_traced_memory()[0]
+        r = fun()
+        return tracemalloc.get_traced_memory()[0] - st, r
+    finally:
+        tracemalloc.stop()
+
+
+def bench_memory(count=10000):
+    # The attribute values are shared, so only the per-instance
+    # overhead is measured
+    for t in [NodeState(node_id=b'foob', seqno=1, age=2, hash=b'12345678'),
+              Neighbor(n_node_id=b'foob', n_ep_id=1, ep_id=2),
+              SHSPKV(json=dict(k='foo', v='bar', ts=1))]:
+        t.encode()
+        state = t.__getstate__()
+        cl = t.__class__
+
+        def _slots():
+            l = [cl.__new__(cl) for i in range(count)]
+            for o in l:
+                o.__setstate__(state)
+            return l
+
+        def _dicts():
+            l = [_DictTLV() for i in range(count)]
+            for o in l:
+                o.__dict__.update(state)
+            return l
+        size, l = _traced_size(_slots)
+        dsize, dl = _traced_size(_dicts)
+        yield dict(name=cl.__name__, count=count,
+                   bytes_per_tlv=size / count,
+                   dict_bytes_per_tlv=dsize / count)
+
+
+BENCHMARKS = dict(codec=bench_codec, encode=bench_encode, hash=bench_hash,
+                  memory=bench_memory)
+
+FORMATS = dict(codec='  %(name)16s %(count)5d x %(size)4d bytes: %(ns_per_op)12.0f ns/op %(alloc_bytes_per_op)10d bytes/op',
+               hash='  %(name)18s %(size)6d bytes: %(ns_per_op)10.0f ns/op %(mb_per_s)8.1f MB/s',
+               encode='  %(count)8d TLVs: %(ns_per_op)14.0f ns/op %(ns_per_tlv)8.1f ns/TLV',
+               memory='  %(name)10s: %(bytes_per_tlv)6.1f bytes/TLV (__dict__: %(dict_bytes_per_tlv)6.1f)')
+
+if __name__ == '__main__':
+    import argparse
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-o', '--output',
+                    help='Write results as JSON to this file')
+    ap.add_argument('benchmark', nargs='*',
+                    help='Benchmarks to run (default: all); one of %s' % ', '.join(sorted(BENCHMARKS.keys())))
+    args = ap.parse_args()
+    for name in args.benchmark:
+        if name not in BENCHMARKS:
+            ap.error('unknown benchmark %s' % name)
+    results = {}
+    for name in args.benchmark or sorted(BENCHMARKS.keys()):
+        print(name)
+        results[name] = []
+        for r in BENCHMARKS[name]():
+            print(FORMATS[name] % r)
+            results[name].append(r)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
@@ -30,9 +30,15 @@ stream support).
 
 import binascii
 import enum
+import functools
 
+import collections
 import random
+import struct
 import bisect
+import heapq
+import itertools
+import threading
 from pysyma.dncp_tlv import *
 
 TLVEvent = enum.Enum('TLVEvent', 'add remove')
@@ -42,14 +48,30 @@ EPEvent = enum.Enum('EPEvent', 'add remove update')
 import logging
 _logger = logging.getLogger(__name__)
 _debug = _logger.debug
+_error = _logger.error
+
+_seqno_struct = struct.Struct('>I')
 
 class Subscriber:
+    # Names of the events the subscriber wants to get; by default,
+    # the ones it overrides the method of (or all of them, if it
+    # overrides handle_event)
+    subscribed_events = None
+    # TLV classes the subscriber wants tlv_event(s) for (None = all)
+    subscribed_tlv_types = None
+
     def handle_event(self, n, *a, **kwa): return getattr(self, n)(*a, **kwa)
 
     # Similar to hnetd
     def republish_event(self): pass
     def local_tlv_event(self, tlv, event): pass
     def tlv_event(self, n, tlv, event): pass
+    # Batched tlv_event; called once per node update
+    def tlv_events(self, n, added, removed):
+        for tlv in removed:
+            self.tlv_event(n, tlv, TLVEvent.remove)
+        for tlv in added:
+            self.tlv_event(n, tlv, TLVEvent.add)
     def node_event(self, n, event): pass
     def ep_event(self, ep, event): pass
     # msg reception callback omitted
@@ -60,6 +82,213 @@ class Subscriber:
     # someone _on the link_.
     def network_consistent_event(self, is_consistent): pass
 
+    # Node n has a new seqno (after its TLVs, if any changed, have
+    # been updated)
+    def node_update_event(self, n): pass
+
+def _overrides(s, name):
+    return getattr(type(s), name, None) is not getattr(Subscriber, name, None)
+
+def _subscriber_handler(s, n, queue=None):
+    # Returns the callable to deliver event n to s with, or None if
+    # s is not interested in it. tlv_event handlers are called with
+    # (node, added, removed) TLV lists. If queue is given, the
+    # returned callable just queues the event there.
+    tlv = n == 'tlv_event'
+    own_dispatch = not isinstance(s, Subscriber) or _overrides(s, 'handle_event')
+    if getattr(s, 'subscribed_events', None) is not None:
+        if n not in s.subscribed_events:
+            return
+    elif not own_dispatch:
+        if not (_overrides(s, n) or (tlv and _overrides(s, 'tlv_events'))):
+            return
+    if not tlv:
+        if own_dispatch:
+            f = functools.partial(s.handle_event, n)
+        else:
+            f = getattr(s, n)
+        if queue is not None:
+            f = queue.wrap(n, f)
+        return f
+    if own_dispatch:
+        def _tlv_events(node, added, removed):
+            for tlv in removed:
+                s.handle_event(n, node, tlv, TLVEvent.remove)
+            for tlv in added:
+                s.handle_event(n, node, tlv, TLVEvent.add)
+        f = _tlv_events
+    else:
+        f = s.tlv_events
+    if queue is not None:
+        f = queue.wrap(n, f)
+    types = getattr(s, 'subscribed_tlv_types', None)
+    if types is None:
+        return f
+    types = tuple(types)
+    def _filtered_tlv_events(node, added, removed):
+        added = [x for x in added if isinstance(x, types)]
+        removed = [x for x in removed if isinstance(x, types)]
+        if added or removed:
+            f(node, added, removed)
+    return _filtered_tlv_events
+
+def _merge_tlv_events(a1, a2):
+    n, added1, removed1 = a1
+    n, added2, removed2 = a2
+    added1, removed1 = set(added1), set(removed1)
+    added2, removed2 = set(added2), set(removed2)
+    # Added + removed (or removed + added) TLVs cancel out
+    added = (added1 - removed2) | (added2 - removed1)
+    removed = (removed1 - added2) | (removed2 - added1)
+    if not added and not removed:
+        return # nothing left to deliver
+    return (n, added, removed)
+
+class SubscriberQueue:
+    """ Queued delivery of events to a subscriber.
+
+    The events are delivered later, either on a later tick of the
+    DNCP loop (at most per_tick at a time), or on a worker thread
+    (thread=True; the subscriber must be thread-safe then). At most
+    maxlen events are queued; policy decides what happens when there
+    are more:
+
+    coalesce: events with an entry in coalescers are merged with the
+    pending one of the same kind (always, not just when full); if the
+    queue is still full, the oldest event is dropped
+
+    drop_oldest: the oldest event is dropped
+
+    drop_newest: the new event is dropped
+
+    The counters and lag (seconds from queueing to delivery) are
+    there for monitoring. """
+    POLICIES = ('coalesce', 'drop_oldest', 'drop_newest')
+    # event name => (key function(args), merge function(old args, new
+    # args); the merge returns None if nothing is left to deliver)
+    coalescers = {
+        'tlv_event': (lambda a: a[0], _merge_tlv_events),
+        'republish_event': (lambda a: None, lambda a1, a2: a2),
+        'network_consistent_event': (lambda a: None, lambda a1, a2: a2),
+        'node_update_event': (lambda a: a[0], lambda a1, a2: a2),
+        }
+    enqueued = 0
+    delivered = 0
+    coalesced = 0
+    dropped = 0
+    max_depth = 0
+    lag = 0
+    max_lag = 0
+    def __init__(self, dncp, maxlen=1000, policy='coalesce',
+                 thread=False, per_tick=100):
+        assert policy in self.POLICIES
+        self.dncp = dncp
+        self.maxlen = maxlen
+        self.policy = policy
+        self.per_tick = per_tick
+        self.queue = collections.deque()
+        self.pending = {} # coalescing key => queue entry
+        self.cond = threading.Condition()
+        self.scheduled = False
+        self.thread = None
+        if thread:
+            self.running = True
+            self.thread = threading.Thread(target=self._worker)
+            self.thread.daemon = True
+            self.thread.start()
+    def __len__(self):
+        return len(self.queue)
+    def wrap(self, n, f):
+        def _queued(*a):
+            self.put(n, f, a)
+        return _queued
+    def put(self, n, f, a):
+        now = self.dncp.sys.time()
+        with self.cond:
+            self.enqueued += 1
+            key = None
+            if self.policy == 'coalesce' and n in self.coalescers:
+                keyf, mergef = self.coalescers[n]
+                key = (n, f, keyf(a))
+                e = self.pending.get(key)
+                if e is not None:
+                    # None = the events cancelled out; the entry is
+                    # skipped when its turn comes
+                    e[2] = mergef(e[2], a)
+                    if e[2] is None:
+                        del self.pending[key]
+                    self.coalesced += 1
+                    return
+            if len(self.queue) >= self.maxlen:
+                self.dropped += 1
+                if self.policy == 'drop_newest':
+                    return
+                e = self.queue.popleft()
+                if self.pending.get(e[0]) is e:
+                    del self.pending[e[0]]
+            e = [key, f, a, now]
+            self.queue.append(e)
+            if key is not None:
+                self.pending[key] = e
+            self.max_depth = max(self.max_depth, len(self.queue))
+            if self.thread is not None:
+                self.cond.notify()
+            elif not self.scheduled:
+                self.scheduled = True
+                self.dncp.sys.schedule(0, self.drain)
+    def _pop(self):
+        # Called with cond held
+        e = self.queue.popleft()
+        if e[0] is not None and self.pending.get(e[0]) is e:
+            del self.pending[e[0]]
+        if e[2] is not None:
+            self.lag = self.dncp.sys.time() - e[3]
+            self.max_lag = max(self.max_lag, self.lag)
+            self.delivered += 1
+        return e
+    def drain(self, limit=None):
+        """ Deliver (at most limit) queued events. """
+        if limit is None and self.thread is None:
+            limit = self.per_tick
+        with self.cond:
+            self.scheduled = False
+        i = 0
+        while limit is None or i < limit:
+            with self.cond:
+                if not self.queue:
+                    return
+                e = self._pop()
+            if e[2] is not None:
+                e[1](*e[2])
+                i += 1
+        with self.cond:
+            if self.queue and self.thread is None and not self.scheduled:
+                self.scheduled = True
+                self.dncp.sys.schedule(0, self.drain)
+    def _worker(self):
+        while True:
+            with self.cond:
+                while self.running and not self.queue:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                e = self._pop()
+            if e[2] is None:
+                continue
+            try:
+                e[1](*e[2])
+            except Exception:
+                _logger.exception('%s subscriber failed', self)
+    def close(self):
+        """ Stop the worker thread (if any); pending events are dropped. """
+        if self.thread is None:
+            return
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+        self.thread = None
+
 class Trickle:
     def __init__(self, **kwargs):
         self.__dict__.update(**kwargs)
@@ -72,6 +301,11 @@ class Trickle:
         self.send_time = now + self.i * (1 + random.random()) / 2
         self.interval_end_time = now + self.i
         self.c = 0
+    def reset(self):
+        # RFC 6206 4.2: if the interval is already Imin, do nothing;
+        # restarting it on every change would just mean more sends
+        if self.i > self.dncp.TRICKLE_IMIN:
+            self.set_i(0)
     def _run(self):
         now = self.dncp.sys.time()
         if now >= self.interval_end_time:
@@ -91,6 +325,236 @@ class Trickle:
             self.last_sent = self.dncp.sys.time()
         self.send_time = self.interval_end_time
 
+class Packetizer:
+    """ Sits between Endpoint.send and the system interface.
+
+    TLVs sent to the same (src, dst) during one tick (DNCP._run,
+    ext_received, or until the next scheduled callback otherwise) are
+    merged, and then split to packets of at most MTU_ISH bytes where
+    possible. Each packet starts with our NodeEP (unless in read-only
+    mode). """
+    scheduled = False
+    def __init__(self, ep):
+        self.ep = ep
+        self.pending = {}
+        self.pacer = ep.dncp.is_paced() and Pacer(self) or None
+        # Statistics
+        self.sends = 0 # Endpoint.send calls
+        self.packets = 0 # packets actually sent
+        self.coalesced = 0 # sends merged with an earlier pending one
+        self.split = 0 # additional packets due to the MTU
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.ep)
+    def packets_saved(self):
+        return self.sends - self.packets
+    def add(self, src, dst, l):
+        self.sends += 1
+        k = (src, dst)
+        if k in self.pending:
+            self.coalesced += 1
+            self.pending[k].extend(l)
+        else:
+            self.pending[k] = list(l)
+        if not self.scheduled:
+            self.scheduled = True
+            self.ep.dncp.sys.schedule(0, self._scheduled_flush)
+    def _scheduled_flush(self):
+        self.scheduled = False
+        self.flush()
+    def flush(self):
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = {}
+        for (src, dst), l in pending.items():
+            if self.pacer is not None:
+                # Urgent TLVs must not share (and wait with) the
+                # packets of bulk ones
+                bl = [t for t in l if self.pacer.is_bulk_tlv(t)]
+                ul = [t for t in l if not self.pacer.is_bulk_tlv(t)]
+                packets = [p for x in (ul, bl) if x
+                           for p in self._packetize(x)] or self._packetize(l)
+                self.split += len(packets) - 1
+                for p in packets:
+                    self.pacer.send(src, dst, p)
+                continue
+            packets = self._packetize(l)
+            self.split += len(packets) - 1
+            for p in packets:
+                self._send(src, dst, p)
+    def _send(self, src, dst, p):
+        _debug('%s sending %s->%s: %s', self, src, dst, p)
+        self.packets += 1
+        self.ep.sys_send(src, dst, p)
+    def _packetize(self, l):
+        dncp = self.ep.dncp
+        lead = []
+        if not dncp.read_only:
+            lead = [NodeEP(node_id=dncp.own_node.node_id,
+                           ep_id=self.ep.ep_id)]
+        lead_size = sum([t.wire_size() for t in lead])
+        packets = []
+        p, size = list(lead), lead_size
+        l = list(reversed(l))
+        while l:
+            t = l.pop()
+            ts = t.wire_size()
+            if size + ts > MTU_ISH:
+                if isinstance(t, NodeStateBatch):
+                    n = (MTU_ISH - size) // t.record_size
+                    if n > 0:
+                        l.append(t[n:])
+                        t = t[:n]
+                        ts = t.wire_size()
+                if size + ts > MTU_ISH and len(p) > len(lead):
+                    # Does not fit; start a new packet. Oversized TLVs
+                    # are sent alone, there is not much else we can do
+                    packets.append(p)
+                    p, size = list(lead), lead_size
+                    l.append(t)
+                    continue
+            p.append(t)
+            size += ts
+        if len(p) > len(lead) or not packets:
+            packets.append(p)
+        return packets
+
+class TokenBucket:
+    """ rate tokens per second, at most burst seconds worth of them
+    saved up. The balance may go negative (see Pacer). """
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.size = rate * burst
+        self.tokens = self.size
+        self.updated = now
+    def is_full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.size
+    def wait(self, n, now):
+        """ Seconds until n tokens are available (0 = now); more than
+        the bucket holds are available when it is full. """
+        self.tokens = min(self.size,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        n = min(n, self.size)
+        if self.tokens >= n:
+            return 0
+        return (n - self.tokens) / self.rate
+    def take(self, n):
+        self.tokens -= n
+
+class Pacer:
+    """ Token bucket pacing of the packets of an Endpoint, both in
+    total and per destination, with byte and packet budgets (see
+    DNCP.PACE_*).
+
+    Packets with NodeState bodies are bulk; they wait (FIFO per src,
+    dst) until there is budget for them. At most PACE_MAX_DEFERRED
+    wait per src, dst; past that, the oldest are dropped (the peer
+    will ask again, as long as the network hash differs). Everything
+    else (NetState, keepalives, requests) is sent right away, but
+    still consumes the budget; the Packetizer never mixes the two in
+    one packet. """
+    scheduled = False
+    def __init__(self, packetizer):
+        self.packetizer = packetizer
+        self.dncp = dncp = packetizer.ep.dncp
+        self.ep_buckets = self._buckets(dncp.PACE_EP_BYTES,
+                                        dncp.PACE_EP_PACKETS)
+        self.dst_buckets = {} # dst => buckets
+        self.last_sweep = dncp.sys.time()
+        self.queues = collections.OrderedDict() # (src, dst) => deque
+        # Statistics
+        self.deferred = 0 # bulk packets that had to wait
+        self.dropped = 0 # bulk packets dropped from a full queue
+        self.overdrafts = 0 # urgent packets sent without budget
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.packetizer.ep)
+    def _buckets(self, byte_rate, packet_rate):
+        now = self.dncp.sys.time()
+        l = []
+        if byte_rate:
+            l.append((TokenBucket(byte_rate, self.dncp.PACE_BURST, now), True))
+        if packet_rate:
+            l.append((TokenBucket(packet_rate, self.dncp.PACE_BURST, now), False))
+        return l
+    def _get_buckets(self, dst):
+        l = self.dst_buckets.get(dst)
+        if l is None:
+            l = self._buckets(self.dncp.PACE_DST_BYTES,
+                              self.dncp.PACE_DST_PACKETS)
+            self.dst_buckets[dst] = l
+        return self.ep_buckets + l
+    def _wait(self, dst, size, now):
+        return max([b.wait(is_bytes and size or 1, now)
+                    for b, is_bytes in self._get_buckets(dst)] or [0])
+    def _send(self, src, dst, p, size):
+        for b, is_bytes in self._get_buckets(dst):
+            b.take(is_bytes and size or 1)
+        self.packetizer._send(src, dst, p)
+    def is_bulk_tlv(self, t):
+        return isinstance(t, NodeState) and bool(t.body)
+    def is_bulk(self, p):
+        for t in p:
+            if self.is_bulk_tlv(t):
+                return True
+        return False
+    def _sweep(self, now):
+        # Buckets that have refilled are the same as new ones; forget
+        # them, so that there is no state for peers long gone
+        self.last_sweep = now
+        busy = set([dst for src, dst in self.queues])
+        for dst, l in list(self.dst_buckets.items()):
+            if dst not in busy and all([b.is_full(now) for b, x in l]):
+                del self.dst_buckets[dst]
+    def send(self, src, dst, p):
+        size = sum([t.wire_size() for t in p])
+        now = self.dncp.sys.time()
+        if now - self.last_sweep >= self.dncp.PACE_BURST:
+            self._sweep(now)
+        k = (src, dst)
+        if not self.is_bulk(p):
+            if self._wait(dst, size, now):
+                self.overdrafts += 1
+            self._send(src, dst, p, size)
+            return
+        q = self.queues.get(k)
+        if q is None:
+            if not self._wait(dst, size, now):
+                self._send(src, dst, p, size)
+                return
+            q = self.queues[k] = collections.deque()
+        _debug('%s deferring %s->%s: %s', self, src, dst, p)
+        self.deferred += 1
+        q.append((p, size))
+        if len(q) > self.dncp.PACE_MAX_DEFERRED:
+            q.popleft()
+            self.dropped += 1
+        self._schedule(now)
+    def _schedule(self, now):
+        if self.scheduled or not self.queues:
+            return
+        dt = min([self._wait(dst, q[0][1], now)
+                  for (src, dst), q in self.queues.items()])
+        self.scheduled = True
+        self.dncp.sys.schedule(dt, self._drain)
+    def _drain(self):
+        self.scheduled = False
+        now = self.dncp.sys.time()
+        # Round-robin across the queues, one packet at a time
+        progress = True
+        while progress:
+            progress = False
+            for k, q in list(self.queues.items()):
+                p, size = q[0]
+                if self._wait(k[1], size, now):
+                    continue
+                q.popleft()
+                self._send(k[0], k[1], p, size)
+                progress = True
+                if not q:
+                    del self.queues[k]
+        self._schedule(now)
+
 class Endpoint:
     # dncp supplied by constructor always
     enabled = False
@@ -100,6 +564,7 @@ class Endpoint:
         self.__dict__.update(**kwargs)
         if self.per_endpoint_ka:
             self.trickle = Trickle(dncp=self.dncp, send=self.send_net_state)
+        self.packetizer = Packetizer(self)
     def __repr__(self):
         nid = self.dncp.own_node.node_id
         nid = binascii.b2a_hex(nid)
@@ -110,15 +575,22 @@ class Endpoint:
         if req:
             l.append(ReqNetState())
         elif dst:
-            for n in self.dncp.valid_sorted_nodes():
-                l.append(n._get_ns(short=True))
+            nodes = self.dncp.valid_sorted_nodes()
+            if self.dncp.BATCH_NODE_STATES:
+                nodes = list(nodes)
+                now = self.dncp.sys.time()
+                l.append(NodeStateBatch([n.node_id for n in nodes],
+                                        [n.seqno for n in nodes],
+                                        [n._get_age(now) for n in nodes],
+                                        [n.get_node_hash() for n in nodes]))
+            else:
+                for n in nodes:
+                    l.append(n._get_ns(short=True))
         self.send(src, dst, l)
     def send(self, src, dst, l):
-        if not self.dncp.read_only:
-            l[0:0] = [NodeEP(node_id=self.dncp.own_node.node_id,
-                             ep_id=self.ep_id)]
+        # NodeEP is added by the packetizer
         _debug('%s send %s->%s: %s', self, src, dst, l)
-        self.sys_send(src, dst, l)
+        self.packetizer.add(src, dst, l)
     def sys_send(self, src, dst, l):
         # By default, use 'global dispatch'. This may be overridden..
         return self.dncp.sys.send(self, src, dst, l)
@@ -138,6 +610,10 @@ class Endpoint:
     def ext_ready(self, enabled):
         if enabled == self.enabled: return
         self.enabled = enabled
+        if not enabled:
+            rns = self.dncp.node_state_requests
+            for key in [k for k in rns if k[0] is self]:
+                del rns[key]
         self.dncp.event('ep_event', self, enabled and EPEvent.add or EPEvent.remove)
 
 # local_tlv = must publish new local node (possibly)
@@ -151,7 +627,8 @@ class Node(TLVList):
     origination_time = 0
     _node_data = None
     _node_hash = None
-    last_reachable = 0
+    last_reachable = 0 # when we last saw the node as reachable
+    reachable = False
     collided = False
     # dncp supplied by constructor always
     def __init__(self, **kwargs):
@@ -173,38 +650,41 @@ class Node(TLVList):
         return self._node_hash
     def is_self(self):
         return self.dncp.own_node is self
-    def set_tlvs(self, tlvs):
+    def set_tlvs(self, tlvs, data=None):
+        # data: tlvs encoded, if known
         tlvs = list(tlvs)
         _debug('%s set_tlvs %s', self, tlvs)
-        # Note: This could be done more efficiently. CBA.
+        # TLVs hash (and compare) using their cached encoding, so this
+        # is linear
         s1 = set(self.tlvs or [])
         s2 = set(tlvs or [])
-        for t1 in s1.difference(s2):
-            self.dncp.event('tlv_event', self, t1, TLVEvent.remove)
+        removed = s1.difference(s2)
+        added = s2.difference(s1)
         self.tlvs = tlvs
-        for t2 in s2.difference(s1):
-            self.dncp.event('tlv_event', self, t2, TLVEvent.add)
-        self.dncp.schedule_immediate_dirty(Dirty.network_hash, Dirty.graph)
-        self._node_data = None
+        if added or removed:
+            self.dncp.emit_tlv_events(self, added, removed)
+        for t in itertools.chain(added, removed):
+            if isinstance(t, KAInterval):
+                self.dncp.ka_interval_changed(self)
+                break
+        self.dncp.links_changed(self,
+                                [t for t in added if isinstance(t, Neighbor)],
+                                [t for t in removed if isinstance(t, Neighbor)])
+        self.dncp.network_hash_dirty(self)
+        self._node_data = data
         self._node_hash = None
-    def _prune_traverse(self):
-        # Already traversed this prune?
-        if self.last_reachable == self.dncp.last_prune:
-            return
-        _debug(' _prune_traverse %s', self)
-        self.last_reachable = self.dncp.last_prune
-        for ntlv, n in self._get_bidir_neighbors():
-            n._prune_traverse()
-    def _get_bidir_neighbors(self):
-        for t1 in self.get_tlv_instances(Neighbor):
-            n = self.dncp.id2node.get(t1.n_node_id)
+    def get_bidir_neighbors(self):
+        """ Yields (Neighbor TLV, Node) of the confirmed peers of the node,
+        i.e. ones which publish the reverse Neighbor TLV too. """
+        dncp = self.dncp
+        ro = self.is_self() and dncp.read_only
+        for t in self.get_tlv_instances(Neighbor):
+            n = dncp.id2node.get(t.n_node_id)
             if not n: continue
-            if self.is_self() and self.dncp.read_only:
+            if ro:
                 yield None, n
-            else:
-                for t2 in n.get_tlv_instances(Neighbor):
-                    if t1.ep_id == t2.n_ep_id and t1.n_ep_id == t2.ep_id and t2.n_node_id == self.node_id:
-                        yield t1, n
+            elif dncp.has_link(t.n_node_id, t.n_ep_id, self.node_id, t.ep_id):
+                yield t, n
     def _get_ns(self, short):
         assert self.seqno
         if not short and self.is_self():
@@ -212,9 +692,11 @@ class Node(TLVList):
         now = self.dncp.sys.time()
         return NodeState(node_id=self.node_id,
                          seqno=self.seqno,
-                         age=int(1000 * (now-self.origination_time)),
+                         age=self._get_age(now),
                          hash=self.get_node_hash(),
                          body=(not short and self.get_node_data() or b''))
+    def _get_age(self, now):
+        return int(1000 * (now-self.origination_time))
     def _update_from_ns(self, ns):
         # Ignore if it's older
         if ns.seqno < self.seqno:
@@ -222,9 +704,10 @@ class Node(TLVList):
         # Ignore if we already have it
         if ns.seqno == self.seqno and ns.hash == self.get_node_hash():
             return
-        if not ns.body:
+        body = ns.body
+        if not body:
             return True
-        if self.dncp.profile_hash(ns.body) != ns.hash:
+        if self.dncp.profile_hash(body) != ns.hash:
             _error('_update_from_ns received corrupted hash')
             return
         if self.is_self():
@@ -237,16 +720,25 @@ class Node(TLVList):
             self.dncp.schedule_immediate_dirty(Dirty.local_tlv,
                                                Dirty.local_always)
             return
-        tlvs = decode_tlvs(ns.body)
-        if tlvs is None:
-            return
+        # Usually just a TLV or two changed; reuse the rest
+        reuse = self.tlvs and tlv_map(self.get_node_data(), self.tlvs) or {}
+        body = bytes(body)
+        tlvs = self.dncp.profile_check_tlvs(
+            self, list(decode_tlvs_reusing(body, reuse)))
         now = self.dncp.sys.time()
         self.seqno = ns.seqno
         self.origination_time = now - ns.age / 1000.0
-        self.set_tlvs(tlvs)
-        self.dncp.schedule_immediate_dirty(Dirty.network_hash)
-        # paranoia starts here:
-        assert self.get_node_hash() == ns.hash
+        # The body was verified above, so it (and its hash) is the
+        # node data as is
+        self.set_tlvs(tlvs, data=body)
+        self._node_hash = ns.hash
+        self.dncp.event('node_update_event', self)
+
+class NodeStateRequests:
+    """ ReqNodeStates sent to (and queued for) one peer. """
+    def __init__(self):
+        self.inflight = {} # node_id => time requested
+        self.queue = collections.OrderedDict() # node_id => True
 
 class SystemInterface:
     def schedule(self, dt, cb):
@@ -268,26 +760,84 @@ class DNCP(TLVList):
     network_hash = None
     read_only = False
     subscriber_class = Subscriber
+    # Handle NodeState dumps in columnar form (NodeStateBatch)
+    BATCH_NODE_STATES = False
+    # Max ReqNodeStates outstanding per peer (None = no limit); the
+    # rest are queued, and requested as the responses come in
+    RNS_INFLIGHT_LIMIT = None
+    RNS_TIMEOUT = 1 # seconds; after this, the request is assumed lost
+    # Send pacing per endpoint and per destination (see Pacer); rates
+    # are per second, and None means unlimited
+    PACE_EP_BYTES = None
+    PACE_EP_PACKETS = None
+    PACE_DST_BYTES = None
+    PACE_DST_PACKETS = None
+    PACE_BURST = 1 # seconds worth of budget that may be saved up
+    PACE_MAX_DEFERRED = 64 # bulk packets waiting per src, dst
+    # Reachability from own_node is maintained incrementally; the
+    # whole graph is traversed only if a link (or node) within the
+    # reachable part of it disappears
+    reachability_full = True
     def __init__(self, sys, **kwa):
         self.__dict__.update(**kwa)
         self.name2ep = {}
         self.id2ep = {}
         self.id2node = {}
         self.node_ids = []
+        self.reachability_roots = set() # may have become reachable
+        # (node_id, ep_id, n_node_id, n_ep_id) => Neighbor TLV published by node
+        self.links = {}
+        # (n_node_id, n_ep_id, ep_id) => our own Neighbor TLV
+        self.local_neighbors = {}
+        self.node_state_requests = {} # (ep, src) => NodeStateRequests
+        # (deadline, counter, Neighbor TLV); the deadlines are lower
+        # bounds, as last_contact only grows (see _prune_neighbors).
+        # Only the entry matching Neighbor.deadline is live.
+        self.neighbor_deadlines = []
+        self.neighbor_deadline_counter = itertools.count()
+        self.unreachable_nodes = set()
         self.first_free_ep_id = 1
         self.dirty = set()
         self.dirty.add(Dirty.network_hash)
+        # Contributions of valid nodes to the network hash, sorted by
+        # node id: seqno + node hash of each in a fixed size slot
+        self.network_hash_ids = []
+        self.network_hash_data = bytearray()
+        self.network_hash_dirty_ids = set()
         self.subscribers = []
+        self.subscriber_queues = [] # SubscriberQueue (if queued) per subscriber
+        self.event_handlers = {} # event name => list of callables
         assert isinstance(sys, SystemInterface)
         self.sys = sys
         self.schedule_immediate_dirty()
-    def add_subscriber(self, s):
+    def add_subscriber(self, s, queued=False, **kw):
+        """ Add subscriber s. With queued=True, its events are delivered
+        asynchronously by a SubscriberQueue (created with kw), which is
+        returned. """
         assert not self.subscriber_class or isinstance(s, self.subscriber_class)
+        q = None
+        if queued:
+            q = SubscriberQueue(self, **kw)
         self.subscribers.append(s)
+        self.subscriber_queues.append(q)
+        self.event_handlers = {}
+        return q
+    def _get_event_handlers(self, n):
+        l = self.event_handlers.get(n)
+        if l is None:
+            l = [_subscriber_handler(s, n, q)
+                 for s, q in zip(self.subscribers, self.subscriber_queues)]
+            l = [h for h in l if h is not None]
+            self.event_handlers[n] = l
+        return l
     def event(self, n, *a, **kw):
         _debug('%s event %s %s %s', self, n, a, kw)
-        for s in self.subscribers:
-            s.handle_event(n, *a, **kw)
+        for h in self._get_event_handlers(n):
+            h(*a, **kw)
+    def emit_tlv_events(self, n, added, removed):
+        _debug('%s emit_tlv_events %s +%s -%s', self, n, added, removed)
+        for h in self._get_event_handlers('tlv_event'):
+            h(n, added, removed)
     def find_ep_by_id(self, ep_id):
         return self.id2ep.get(ep_id, None)
     def find_ep_by_name(self, name):
@@ -318,31 +868,56 @@ class DNCP(TLVList):
             self.own_node = n
         self.id2node[n.node_id] = n
         self.event('node_event', n, NodeEvent.add)
-        self.schedule_immediate_dirty(Dirty.graph)
+        if own:
+            n.reachable = True
+            self.reachability_changed(full=True)
+        else:
+            self.unreachable_nodes.add(n)
+            if self.read_only and self.own_node is not None:
+                # Our own (unidirectional) link may point at it already
+                for t in self.own_node.get_tlv_instances(Neighbor):
+                    if t.n_node_id == n.node_id:
+                        self.reachability_changed(full=True)
+                        break
         bisect.insort(self.node_ids, n.node_id)
         return n
     def remove_node(self, n):
         _debug('%s remove_node %s', self, n)
         del self.id2node[n.node_id]
         self.event('node_event', n, NodeEvent.remove)
-        self.schedule_immediate_dirty(Dirty.graph)
+        for t in n.get_tlv_instances(Neighbor):
+            self.links.pop((n.node_id, t.ep_id, t.n_node_id, t.n_ep_id), None)
+        if n.get_tlv_instances(KAInterval):
+            self.ka_interval_changed(n)
+        if n.reachable:
+            self.reachability_changed(full=True)
+        self.unreachable_nodes.discard(n)
+        self.network_hash_dirty(n)
         self.node_ids.remove(n.node_id)
     def add_tlv(self, x):
-        if self.tlvs is None: self.tlvs = []
         ox = self.has_tlv(x)
         if ox is not None: return ox
         assert isinstance(x, Neighbor) or not self.read_only
         _debug('%s add_tlv %s', self, x)
-        bisect.insort(self.tlvs, x)
+        self._insert_tlv(x)
         if isinstance(x, ContainerTLV): x.parent = self
+        if isinstance(x, Neighbor):
+            self.local_neighbors[(x.n_node_id, x.n_ep_id, x.ep_id)] = x
+            self._push_neighbor_deadline(x)
         self.event('local_tlv_event', x, TLVEvent.add)
         self.schedule_immediate_dirty(Dirty.local_tlv)
         return x
     def remove_tlv(self, x):
         _debug('%s remove_tlv %s', self, x)
-        if isinstance(x, ContainerTLV): del x.parent
-        assert x in self.tlvs, '%s not in %s' % (x, self.tlvs)
-        self.tlvs.remove(x)
+        if isinstance(x, ContainerTLV): x.parent = None
+        self._delete_tlv(x)
+        if isinstance(x, Neighbor):
+            del self.local_neighbors[(x.n_node_id, x.n_ep_id, x.ep_id)]
+            tr = getattr(x, 'trickle', None)
+            if tr is not None:
+                # Per-peer neighbor; we know its address
+                self.node_state_requests.pop((self.id2ep.get(x.ep_id),
+                                              tr.addrs[0]), None)
         self.event('local_tlv_event', x, TLVEvent.remove)
         self.schedule_immediate_dirty(Dirty.local_tlv)
     def schedule_immediate_dirty(self, *args):
@@ -356,46 +931,153 @@ class DNCP(TLVList):
         for ep in self.id2ep.values():
             if ep.enabled:
                 yield ep
+    def is_paced(self):
+        return bool(self.PACE_EP_BYTES or self.PACE_EP_PACKETS or
+                    self.PACE_DST_BYTES or self.PACE_DST_PACKETS)
+    def is_valid_node(self, n):
+        if n.is_self():
+            if self.read_only and len(n.get_tlvs()) == len(n.get_tlv_instances(Neighbor)):
+                return False
+        return bool(n.tlvs) and n.reachable
     def valid_sorted_nodes(self):
         for nid in self.node_ids:
             n = self.id2node[nid]
-            if n.is_self():
-                if self.read_only and not len(list(n.get_tlv_matching(lambda t:not isinstance(t, Neighbor)))):
-                    continue
-            if n.tlvs and n.last_reachable == self.last_prune:
+            if self.is_valid_node(n):
                 yield n
-    def _prune(self):
-        if not Dirty.graph in self.dirty:
+    def reachability_changed(self, full=False, root=None):
+        if full:
+            self.reachability_full = True
+        if root is not None:
+            self.reachability_roots.add(root)
+        self.schedule_immediate_dirty(Dirty.graph)
+    def has_link(self, node_id, ep_id, n_node_id, n_ep_id):
+        """ Does node_id publish a Neighbor TLV for the given link. """
+        return (node_id, ep_id, n_node_id, n_ep_id) in self.links
+    def has_bidir_link(self, node_id, ep_id, n_node_id, n_ep_id):
+        return (self.has_link(node_id, ep_id, n_node_id, n_ep_id) and
+                self.has_link(n_node_id, n_ep_id, node_id, ep_id))
+    def links_changed(self, n, added, removed):
+        # Called with the Neighbor TLVs added to and removed from n
+        links = self.links
+        for t in removed:
+            links.pop((n.node_id, t.ep_id, t.n_node_id, t.n_ep_id), None)
+        for t in added:
+            links[(n.node_id, t.ep_id, t.n_node_id, t.n_ep_id)] = t
+        if self.read_only and n.is_self():
+            # Nobody links back to us (we publish no NodeEP); the own
+            # links are unidirectional (see get_bidir_neighbors)
+            if added or removed:
+                self.reachability_changed(full=True)
             return
-        _debug('_prune')
-        self.dirty.remove(Dirty.graph)
-        # Ok, let's run prune
+        for t in removed:
+            if not n.reachable: break
+            m = self.id2node.get(t.n_node_id)
+            if m is None or not m.reachable: continue
+            # Only bidirectional links count
+            if self.has_link(t.n_node_id, t.n_ep_id, n.node_id, t.ep_id):
+                self.reachability_changed(full=True)
+                return
+        for t in added:
+            m = self.id2node.get(t.n_node_id)
+            if m is None or n.reachable == m.reachable: continue
+            self.reachability_changed(root=(n.reachable and m or n))
+    def _update_reachability(self, now):
+        if self.reachability_full:
+            _debug('_update_reachability (full)')
+            was = set([n for n in self.id2node.values() if n.reachable])
+            for n in was:
+                n.reachable = False
+            roots = [self.own_node]
+        else:
+            was = set()
+            roots = [n for n in self.reachability_roots
+                     if not n.reachable and self.id2node.get(n.node_id) is n
+                     and any([m.reachable for t, m in n.get_bidir_neighbors()])]
+        self.reachability_full = False
+        self.reachability_roots = set()
+        l = []
+        for n in roots:
+            if not n.reachable:
+                n.reachable = True
+                l.append(n)
+        while l:
+            n = l.pop()
+            if n in was:
+                was.remove(n)
+            else:
+                _debug(' reachable %s', n)
+                n.last_reachable = now
+                self.unreachable_nodes.discard(n)
+                self.network_hash_dirty(n)
+            for ntlv, m in n.get_bidir_neighbors():
+                if not m.reachable:
+                    m.reachable = True
+                    l.append(m)
+        for n in was:
+            _debug(' unreachable %s', n)
+            n.last_reachable = now
+            self.unreachable_nodes.add(n)
+            self.network_hash_dirty(n)
+    def _prune(self):
         now = self.sys.time()
-        self.last_prune = now
-        self.own_node._prune_traverse()
-        # Eliminate unreachable nodes
+        if Dirty.graph in self.dirty:
+            _debug('_prune')
+            self.dirty.remove(Dirty.graph)
+            self.last_prune = now
+            self._update_reachability(now)
+        # Eliminate nodes that have been unreachable for too long
         pending_remove = []
-        for node in self.id2node.values():
+        for node in self.unreachable_nodes:
             if node.last_reachable and (node.last_reachable + self.GRACE_INTERVAL) < now:
                 pending_remove.append(node)
         for node in pending_remove:
             self.remove_node(node)
-        self.dirty.add(Dirty.network_hash)
+    def _get_neighbor_deadline(self, ntlv):
+        n = self.id2node.get(ntlv.n_node_id)
+        ka_interval = self.KEEPALIVE_INTERVAL
+        if n:
+            ka_tlvs = list([t for t in n.get_tlv_instances(KAInterval) if t.ep_id == ntlv.ep_id or not t.ep_id])
+            if ka_tlvs: ka_interval = ka_tlvs[-1].interval / 1000.0
+        dead_interval = ka_interval * self.KEEPALIVE_MULTIPLIER
+        return ntlv.last_contact + dead_interval
+    def _push_neighbor_deadline(self, ntlv, deadline=None):
+        if deadline is None:
+            deadline = self._get_neighbor_deadline(ntlv)
+        ntlv.deadline = deadline
+        h = self.neighbor_deadlines
+        if len(h) > 2 * len(self.local_neighbors) + 16:
+            # Too many stale entries; keep just the live ones
+            h[:] = [e for e in h if self._is_live_neighbor_deadline(e)]
+            heapq.heapify(h)
+        heapq.heappush(h, (deadline, next(self.neighbor_deadline_counter), ntlv))
+    def _is_live_neighbor_deadline(self, e):
+        deadline, i, ntlv = e
+        key = (ntlv.n_node_id, ntlv.n_ep_id, ntlv.ep_id)
+        return (self.local_neighbors.get(key) is ntlv and
+                ntlv.deadline == deadline)
+    def ka_interval_changed(self, n):
+        # Deadlines of neighbors on n may have moved earlier; if they
+        # moved later, the current entry is still a valid lower bound
+        for ntlv in self.get_tlv_instances(Neighbor):
+            if ntlv.n_node_id == n.node_id:
+                deadline = self._get_neighbor_deadline(ntlv)
+                if deadline < ntlv.deadline:
+                    self._push_neighbor_deadline(ntlv, deadline)
     def _prune_neighbors(self):
         _debug('_prune_neighbors')
         now = self.sys.time()
-        for ntlv in list(self.get_tlv_instances(Neighbor)):
-            n = self.id2node.get(ntlv.n_node_id)
-            ka_interval = self.KEEPALIVE_INTERVAL
-            if n:
-                ka_tlvs = list([t for t in n.get_tlv_instances(KAInterval) if t.ep_id == ntlv.ep_id or not t.ep_id])
-                if ka_tlvs: ka_interval = ka_tlvs[-1].interval / 1000.0
-                #_debug('ka_tlvs for %s: %s', n, ka_tlvs)
-            dead_interval = ka_interval * self.KEEPALIVE_MULTIPLIER
-            ttl = (ntlv.last_contact + dead_interval) - now
-            if ttl < 0:
+        h = self.neighbor_deadlines
+        while h and h[0][0] <= now:
+            e = heapq.heappop(h)
+            if not self._is_live_neighbor_deadline(e):
+                continue # removed or superseded already
+            ntlv = e[2]
+            deadline = self._get_neighbor_deadline(ntlv)
+            _debug(' %s ttl %s', ntlv, deadline - now)
+            if deadline <= now:
                 self.remove_tlv(ntlv)
-            _debug(' %s ttl %s', ntlv, ttl)
+            else:
+                self._push_neighbor_deadline(ntlv, deadline)
     def _run(self):
         _debug('%s _run', self)
         self.scheduled_immediate = False
@@ -410,6 +1092,15 @@ class DNCP(TLVList):
         self.get_network_hash()
         for ep in self.enabled_eps():
             next = min(filter(None, [next, ep._run()]))
+        deadline = self._prune_node_state_requests(now)
+        if deadline is not None:
+            next = min(next, deadline)
+        if self.neighbor_deadlines:
+            if self.neighbor_deadlines[0][0] <= now:
+                self.schedule_immediate_dirty() # e.g. KAInterval shrank
+            else:
+                next = min(next, self.neighbor_deadlines[0][0])
+        self._flush_sends()
         if self.scheduled_immediate:
             return
         if self.dirty:
@@ -422,26 +1113,46 @@ class DNCP(TLVList):
         _debug('_run done - next: %s > %s', next, now)
         self.sys.schedule(next - now, self._run)
         self.scheduled_run = next
+    def network_hash_dirty(self, n):
+        # The seqno, hash or validity of n may have changed
+        self.network_hash_dirty_ids.add(n.node_id)
+        self.schedule_immediate_dirty(Dirty.network_hash)
+    def _update_network_hash_data(self):
+        ids = self.network_hash_ids
+        data = self.network_hash_data
+        size = _seqno_struct.size + self.HASH_LENGTH
+        for nid in self.network_hash_dirty_ids:
+            n = self.id2node.get(nid)
+            i = bisect.bisect_left(ids, nid)
+            found = i < len(ids) and ids[i] == nid
+            ofs = i * size
+            if n is not None and self.is_valid_node(n):
+                h = n.get_node_hash()
+                _debug(' %s %d %s', n.get_node_id_hex(), n.seqno,
+                       binascii.b2a_hex(h))
+                assert len(h) == self.HASH_LENGTH
+                if not found:
+                    ids.insert(i, nid)
+                    data[ofs:ofs] = bytes(size)
+                _seqno_struct.pack_into(data, ofs, n.seqno)
+                data[ofs+_seqno_struct.size:ofs+size] = h
+            elif found:
+                del ids[i]
+                del data[ofs:ofs+size]
+        self.network_hash_dirty_ids.clear()
     def get_network_hash(self):
         if Dirty.network_hash in self.dirty:
             self.dirty.remove(Dirty.network_hash)
             _debug('%s _calculate_network_hash', self)
-            l = list([(struct.pack('>I', n.seqno) + n.get_node_hash()) for n in self.valid_sorted_nodes()])
-            for n in self.valid_sorted_nodes():
-                _debug(' %s %d %s', n.get_node_id_hex(), n.seqno,
-                       n.get_node_hash_hex())
-            if l:
-                data = functools.reduce(operator.add, l)
-            else:
-                data = b''
-            data = self.profile_hash(data)
+            self._update_network_hash_data()
+            data = self.profile_hash(self.network_hash_data)
             if data != self.network_hash:
                 _debug('=> %s', binascii.b2a_hex(data))
                 self.network_hash = data
                 # Reset Trickle
                 for ep in self.name2ep.values():
                     for t in ep.get_trickles():
-                        t.set_i(0)
+                        t.reset()
             self.is_consistent() # send update if we match network
         return self.network_hash
     def get_network_hash_hex(self):
@@ -458,34 +1169,52 @@ class DNCP(TLVList):
         except KeyError:
             pass
         self.event('republish_event')
-        # To be sure nested dependencies are handled fine, we encode +
-        # decode it right here..
-        nl = []
-        if self.tlvs:
-            b = encode_tlvs(*self.tlvs)
-            nl = list(decode_tlvs(b))
-            assert nl
-        self.own_node.set_tlvs(nl)
+        # The published TLVs must not change when the local ones are
+        # mutated (e.g. containers), so own_node gets a decoded
+        # snapshot of them. Unchanged TLVs are reused from the
+        # previous snapshot, so only what changed is decoded.
+        b = encode_tlvs(*(self.tlvs or []))
+        n = self.own_node
+        reuse = n.tlvs and tlv_map(n.get_node_data(), n.tlvs) or {}
+        n.set_tlvs(decode_tlvs_reusing(b, reuse), data=b)
         self.own_node.seqno += 1
         self.own_node.origination_time = self.sys.time()
-        self.schedule_immediate_dirty(Dirty.network_hash)
+        self.network_hash_dirty(self.own_node)
+        self.event('node_update_event', self.own_node)
+    def _update_from_ns_batch(self, b):
+        # Equivalent of Node._update_from_ns for NodeStates without
+        # body; yields the node ids that we should request
+        id2node = self.id2node
+        for node_id, seqno, h in zip(b.node_ids, b.seqnos, b.hashes):
+            n = id2node.get(node_id)
+            if n is None:
+                self.find_or_create_node_by_id(node_id)
+            elif seqno < n.seqno:
+                continue
+            elif seqno == n.seqno and h == n.get_node_hash():
+                continue
+            yield node_id
     def _heard(self, ep, src, dst, eptlv):
         # don't add self as neighbor, ever
-        if eptlv.node_id == self.own_node.node_id: return
-        ftlv = Neighbor(n_node_id=eptlv.node_id,
-                        n_ep_id=eptlv.ep_id,
+        node_id = eptlv.node_id
+        if node_id == self.own_node.node_id: return
+        ntlv = self.local_neighbors.get((node_id, eptlv.ep_id, ep.ep_id))
+        if ntlv is not None or dst is None:
+            return ntlv
+        return self._add_neighbor(ep, src, dst, node_id, eptlv.ep_id)
+    def _add_neighbor(self, ep, src, dst, node_id, n_ep_id, last_contact=None):
+        ftlv = Neighbor(n_node_id=node_id,
+                        n_ep_id=n_ep_id,
                         ep_id=ep.ep_id)
-        for ntlv in self.get_tlv_instances(Neighbor):
-            if ftlv == ntlv:
-                return ntlv
-        if dst is None:
-            return
-        ftlv.last_contact = self.sys.time()
+        if last_contact is None:
+            last_contact = self.sys.time()
+        ftlv.last_contact = last_contact
         if ep.per_peer_ka:
             def _send_net_state():
                 ep.send_net_state(src=dst, dst=src)
                 ftlv.trickle.last_sent = self.sys.time()
-            ftlv.trickle = Trickle(dncp=self, send=_send_net_state)
+            ftlv.trickle = Trickle(dncp=self, send=_send_net_state,
+                                   addrs=(src, dst))
         return self.add_tlv(ftlv)
     def is_consistent(self):
         is_consistent = self.last_seen_network_hash == self.get_network_hash()
@@ -495,29 +1224,37 @@ class DNCP(TLVList):
         return is_consistent
     def ext_received(self, ep, src, dst, l):
         #l = decode_tlvs(body)
-        l = list(l)
+        if self.BATCH_NODE_STATES:
+            l = batch_node_states(l)
+        else:
+            l = list(l)
         _debug('%s ext_received on %s : %s -> %s - %s', self, ep, src, dst, l)
         ne = None
         now = self.sys.time()
         nep = None
         assert src is not None
         want_rns = False
+        want_ns = [] # node ids to request from src
+        responses = []
         for t in l:
-            if isinstance(t, NodeEP):
+            # t may be also a TLVView; most NodeStates are dropped
+            # based on the header alone, so we do not decode them fully
+            cl = tlv_class(t)
+            if issubclass(cl, NodeEP):
                 ne = self._heard(ep, src, dst, t)
                 if dst is None and ne is None:
                     want_rns = True
-            elif isinstance(t, ReqNetState):
+            elif issubclass(cl, ReqNetState):
                 ep.send_net_state(src=dst, dst=src)
                 if ne and ep.per_peer_ka:
                     ne.trickle.last_sent = self.sys.time()
-            elif isinstance(t, ReqNodeState):
+            elif issubclass(cl, ReqNodeState):
                 n = self.id2node.get(t.node_id)
-                if n and n.last_reachable == self.last_prune:
-                    ep.send(dst, src, [n._get_ns(short=False)])
+                if n and n.reachable:
+                    responses.append(n._get_ns(short=False))
                 else:
                     _debug(' ignoring reqnodestate %s, not up to date', t)
-            elif isinstance(t, NetState):
+            elif issubclass(cl, NetState):
                 self.last_seen_network_hash = t.hash
                 is_consistent = self.is_consistent()
                 _debug('NetState is %s (%s)', is_consistent, ne)
@@ -526,9 +1263,13 @@ class DNCP(TLVList):
                         ne.last_contact = now
                 else:
                     want_rns = True
-            elif isinstance(t, NodeState):
+            elif issubclass(cl, NodeState):
+                if t.body:
+                    self._node_state_received(ep, src, t.node_id)
                 if self.find_or_create_node_by_id(t.node_id)._update_from_ns(t):
-                    ep.send(dst, src, [ReqNodeState(node_id=t.node_id)])
+                    want_ns.append(t.node_id)
+            elif issubclass(cl, NodeStateBatch):
+                want_ns.extend(self._update_from_ns_batch(t))
             else:
                 _error('unknown top-level TLV: %s', t)
         if dst and ne:
@@ -536,16 +1277,90 @@ class DNCP(TLVList):
         if want_rns and (self.last_rns + self.TRICKLE_IMIN) < now:
             self.last_rns = now
             ep.send_net_state(src=dst, dst=src, req=True)
+        # Responses and requests are sent in one go, so that the
+        # packetizer can pack them to as few datagrams as possible
+        if responses:
+            ep.send(dst, src, responses)
+        if want_ns or (ep, src) in self.node_state_requests:
+            self._request_node_states(ep, src, dst, want_ns)
+        self._flush_sends()
+    def _prune_node_state_requests(self, now):
+        # Requests without an answer in RNS_TIMEOUT are forgotten. If
+        # nothing is in flight then, the peer has gone quiet (or away),
+        # and the queued ones are dropped too; they are requested
+        # again if the hashes still differ. Returns the next deadline.
+        next = None
+        for key, r in list(self.node_state_requests.items()):
+            for node_id, t in list(r.inflight.items()):
+                if t + self.RNS_TIMEOUT <= now:
+                    del r.inflight[node_id]
+                elif next is None or t + self.RNS_TIMEOUT < next:
+                    next = t + self.RNS_TIMEOUT
+            if not r.inflight:
+                del self.node_state_requests[key]
+        return next
+    def _node_state_received(self, ep, src, node_id):
+        r = self.node_state_requests.get((ep, src))
+        if r is not None:
+            r.inflight.pop(node_id, None)
+    def _request_node_states(self, ep, src, dst, node_ids):
+        key = (ep, src)
+        r = self.node_state_requests.get(key)
+        if r is None:
+            r = NodeStateRequests()
+            self.node_state_requests[key] = r
+        now = self.sys.time()
+        for node_id, t in list(r.inflight.items()):
+            if t + self.RNS_TIMEOUT < now:
+                del r.inflight[node_id]
+        for node_id in node_ids:
+            if node_id not in r.inflight:
+                r.queue[node_id] = True
+        limit = self.RNS_INFLIGHT_LIMIT
+        l = []
+        while r.queue and (limit is None or len(r.inflight) < limit):
+            node_id = r.queue.popitem(last=False)[0]
+            r.inflight[node_id] = now
+            l.append(ReqNodeState(node_id=node_id))
+        if l:
+            ep.send(dst, src, l)
+        if not r.inflight and not r.queue:
+            del self.node_state_requests[key]
+    def _flush_sends(self):
+        for ep in self.id2ep.values():
+            ep.packetizer.flush()
+    def get_snapshot_tlvs(self):
+        # Local TLVs worth restoring after a restart (see
+        # pysyma.snapshot); neighbors have to be rediscovered
+        return [t for t in self.tlvs if not isinstance(t, Neighbor)]
+    def restore_snapshot_tlvs(self, tlvs):
+        for t in tlvs:
+            self.add_tlv(t)
 
     def profile_collision(self):
         raise NotImplementedError # child responsibility
     def profile_hash(self, h):
         raise NotImplementedError # child responsibility
+    def profile_check_tlvs(self, n, tlvs):
+        # Called with the received TLVs of n before they are applied
+        # (the ones n already had are the same objects); profiles may
+        # e.g. neuter unauthenticated ones here
+        return tlvs
 
 
 import hashlib
 
+# name => function(data, length) returning a hash of the given length
+PROFILE_HASHES = {
+    'md5': lambda b, n: hashlib.md5(b).digest()[:n],
+    'sha256': lambda b, n: hashlib.sha256(b).digest()[:n],
+    'blake2b': lambda b, n: hashlib.blake2b(b, digest_size=n).digest(),
+    }
+
 class HNCP(DNCP):
+    # HNCP itself mandates md5; private profiles (that do not need to
+    # interoperate with HNCP) may use e.g. blake2b instead
+    HASH_ALGORITHM = 'md5'
     HASH_LENGTH = 8
     NODE_ID_LENGTH = 4
     TRICKLE_IMIN = 0.2
@@ -568,7 +1383,7 @@ class HNCP(DNCP):
         DNCP.__init__(self, sys, **kw)
         self._set_id(node_id)
     def profile_hash(self, b):
-        return hashlib.md5(b).digest()[:self.HASH_LENGTH]
+        return PROFILE_HASHES[self.HASH_ALGORITHM](b, self.HASH_LENGTH)
     def profile_collision(self):
         self._set_id(None)
 
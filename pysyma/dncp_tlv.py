@@ -21,9 +21,11 @@ yet, find one to reuse.
 """
 
 import struct
-import operator
 import functools
 import bisect
+import operator
+import types
+import array
 
 RID_LEN = 8
 MTU_ISH = 1400 # random MTU we use for splitting TLVs when we send stuff
@@ -32,6 +34,7 @@ UPDATE_FLAG_SET_DEFAULT_PREFIX=0x80
 UPDATE_FLAG_SET_DEFAULT_RID=0x40
 
 class Blob:
+    __slots__ = ()
     def __init__(self, **kw):
         for k, v in kw.items():
             setattr(self, k, v)
@@ -42,9 +45,16 @@ class Blob:
         return o
     def encode(self):
         raise NotImplementedError
+    def encode_into(self, buf, ofs=0):
+        # Fallback for blobs that only know how to encode() themselves
+        b = self.encode()
+        end = ofs + len(b)
+        buf[ofs:end] = b
+        return end
     def decode_buffer(self, x):
         raise NotImplementedError
     def __eq__(self, o):
+        if self is o: return True
         return type(self) == type(o) and self.encode() == o.encode()
     def __lt__(self, o):
         return self.encode() < o.encode()
@@ -53,45 +63,157 @@ class Blob:
 
 functools.total_ordering(Blob)
 
-try:
-    buffer('foo')
-except:
-    def buffer(x): return x
-
-class CStruct(Blob):
+class _CStructMeta(type):
+    """ Gives CStruct subclasses __slots__ generated from their keys
+    (and any additional __slots__ they declare), as there are lots of
+    TLV instances around and a __dict__ for each is expensive.
+
+    Class level values of the slots become per-instance defaults
+    (_defaults), except for keys that the class gives a value to but
+    which are slots in a parent (e.g. 't' of most TLVs); those are
+    constant for the class and stay as class attributes. """
+    def __new__(mcs, name, bases, ns):
+        inherited = set()
+        for b in bases:
+            for c in b.__mro__:
+                inherited.update(c.__dict__.get('__slots__', ()))
+        keys = ns.get('keys', None)
+        if keys is None:
+            keys = getattr(bases[0], 'keys', [])
+        slots = list(ns.get('__slots__', ()))
+        for k in keys:
+            if k not in inherited and k not in slots:
+                slots.append(k)
+        defaults = {}
+        for k in list(ns.keys()):
+            if k in slots or (k in inherited and k not in keys):
+                defaults[k] = ns.pop(k)
+        ns['__slots__'] = tuple(slots)
+        ns['_own_defaults'] = defaults
+        cls = type.__new__(mcs, name, bases, ns)
+        cls._defaults = {}
+        for c in reversed(cls.__mro__):
+            cls._defaults.update(c.__dict__.get('_own_defaults', {}))
+        # Per-instance state; anything else is constant for the class
+        cls._state_keys = []
+        transient = getattr(cls, 'transient', ())
+        for c in reversed(cls.__mro__):
+            for k in c.__dict__.get('__slots__', ()):
+                if k in transient: continue
+                if isinstance(getattr(cls, k), types.MemberDescriptorType):
+                    cls._state_keys.append(k)
+        cls._codec = None # see get_codec
+        return cls
+
+class CStructCodec:
+    """ Precompiled encoder/decoder for the fields of a CStruct class.
+
+    All fields are packed/unpacked with a single struct call, and the
+    decoded values are stored directly to the slots, without going
+    through __setattr__ (or comparing them to the old values first).
+    Fields that are constant for the class (e.g. 't') are not stored.
+
+    Profiles may provide faster codecs for their own TLVs by
+    subclassing this and setting codec_class of the TLV class. """
+    def __init__(self, cls):
+        self.cls = cls
+        self.fmt = cls.get_format()
+        self.size = self.fmt.size
+        assert len(cls.keys) > 1
+        self.get_fields = operator.attrgetter(*cls.keys)
+        self.setters = [(i, getattr(cls, k).__set__)
+                        for i, k in enumerate(cls.keys)
+                        if k in cls._state_keys]
+    def decode(self, x, ofs=0):
+        o = self.cls()
+        o.decode_buffer(x, ofs)
+        return o
+    def decode_into(self, o, x, ofs=0):
+        v = self.fmt.unpack_from(x, ofs)
+        for i, setter in self.setters:
+            setter(o, v[i])
+        _set_encoded(o, None)
+    def encode_into(self, o, buf, ofs=0):
+        self.fmt.pack_into(buf, ofs, *self.get_fields(o))
+        return ofs + self.size
+
+class CStruct(Blob, metaclass=_CStructMeta):
     format = None # subclass responsibility
     keys = [] # subclass responsibility
     arkeys = None # additional repr-keys
+    codec_class = CStructCodec
+    transient = () # slots which are just derived caches, not state
+    # Cached result of encode(); comparisons and hashing use it, so
+    # it is dropped whenever something that is encoded changes.
+    __slots__ = ['_encoded']
+    _encoded = None
     def __init__(self, **kw):
+        for k, v in self._defaults.items():
+            object.__setattr__(self, k, v)
         Blob.__init__(self, **kw)
+    def __setattr__(self, k, v):
+        if k in self.keys or k == 'body':
+            object.__setattr__(self, '_encoded', None)
+        object.__setattr__(self, k, v)
+    def __getstate__(self):
+        d = {}
+        for k in self._state_keys:
+            try:
+                d[k] = getattr(self, k)
+            except AttributeError:
+                pass
+        return d
+    def __setstate__(self, d):
+        # Transient slots are not in d; they start from the defaults
+        for k, v in self._defaults.items():
+            object.__setattr__(self, k, v)
+        for k, v in d.items():
+            object.__setattr__(self, k, v)
     def __hash__(self):
-        h = 0
-        for key in self.keys:
-            h = h ^ hash(getattr(self, key, None))
-        return h
+        return hash(self.encode())
     def __repr__(self):
-        ark = self.arkeys or []
+        ark = [k for k in self.arkeys or [] if getattr(self, k, None) is not None and k not in self.keys]
         return '%s(%s)' % (self.__class__.__name__,
-                           ', '.join(['%s=%s' % (k, repr(v)) for k, v in self.__dict__.items() if k in self.keys or k in ark]))
+                           ', '.join(['%s=%s' % (k, repr(getattr(self, k))) for k in self.keys + ark if hasattr(self, k)]))
     def copy(self):
-        return self.__class__(**self.__dict__)
-    def get_format(self):
-        # We store this in __class__ instead of self (ugly but fast)
-        if '_fmt' not in self.__class__.__dict__:
-            self.__class__._fmt = struct.Struct(self.format)
-        return self._fmt
+        return self.__class__(**self.__getstate__())
+    @classmethod
+    def get_format(cls):
+        # We store this in the class instead of self (ugly but fast)
+        if '_fmt' not in cls.__dict__:
+            cls._fmt = struct.Struct(cls.format)
+        return cls._fmt
+    @classmethod
+    def get_codec(cls):
+        # Every class has its own _codec (set by _CStructMeta)
+        if cls._codec is None:
+            cls._codec = cls.codec_class(cls)
+        return cls._codec
     def encode(self):
-        fmt = self.get_format()
-        return fmt.pack(*[getattr(self, k) for k in self.keys])
+        e = self._encoded
+        if e is None:
+            b = bytearray(self.wire_size())
+            self._encode_into(b, 0)
+            e = bytes(b)
+            self._encoded = e
+        return e
+    def encode_into(self, buf, ofs=0):
+        e = self._encoded
+        if e is None:
+            return self._encode_into(buf, ofs)
+        end = ofs + len(e)
+        buf[ofs:end] = e
+        return end
+    def _encode_into(self, buf, ofs):
+        return self.get_codec().encode_into(self, buf, ofs)
     def decode_buffer(self, x, ofs=0):
-        x = buffer(x)
-        fmt = self.get_format()
-        for k, v in zip(self.keys, fmt.unpack_from(x, ofs)):
-            if hasattr(self, k) and getattr(self, k) == v:
-                continue
-            setattr(self, k, v)
+        self.get_codec().decode_into(self, x, ofs)
     def format_size(self):
         return self.get_format().size
+    def wire_size(self):
+        return self.format_size()
+
+_set_encoded = CStruct.__dict__['_encoded'].__set__
 
 # Observe hardcoded lengths (matching HNCP) of hash/node id
 # length.. 4s/8s are the fields to replace :)
@@ -99,49 +221,83 @@ class CStruct(Blob):
 class TLV(CStruct):
     format = '>HH'
     keys = ['t', 'l']
-    def wire_size(self):
-        return self.format_size()
-    def encode(self):
+    def _encode_into(self, buf, ofs):
         self.l = self.wire_size() - TLV_SIZE
-        return CStruct.encode(self)
+        return CStruct._encode_into(self, buf, ofs)
 
 TLV_SIZE=TLV().wire_size()
 PAD_TO=4
+_PADDING=bytes(PAD_TO)
 
 class PadBodyTLV(TLV):
+    __slots__ = ['body']
     arkeys = ['body']
     body = b''
     def decode_buffer(self, x, ofs=0):
-        TLV.decode_buffer(self, x, ofs)
-        bofs = ofs + self.format_size()
-        blen = self.l - self.format_size() + TLV_SIZE
-        b = x[bofs:bofs+blen]
-        if b != self.body:
-            self.body = b
+        codec = self.get_codec()
+        codec.decode_into(self, x, ofs)
+        # x may be a memoryview; the object must not keep it alive
+        self.body = bytes(x[ofs + codec.size:ofs + TLV_SIZE + self.l])
+    def get_body(self):
+        # Subclasses with lazily produced bodies override this
+        return self.body
     def pad_size(self):
-        return PAD_TO and ((PAD_TO - len(self.body)) % PAD_TO) or 0
+        return PAD_TO and ((PAD_TO - len(self.get_body())) % PAD_TO) or 0
     def wire_size(self):
-        return TLV.wire_size(self) + len(self.body) + self.pad_size()
-    def encode(self):
-        self.l = TLV.wire_size(self) + len(self.body) - TLV_SIZE
-        return CStruct.encode(self) + self.body + bytearray([0] * self.pad_size())
+        return self.format_size() + len(self.get_body()) + self.pad_size()
+    def _encode_into(self, buf, ofs):
+        body = self.get_body()
+        self.l = self.format_size() + len(body) - TLV_SIZE
+        ofs = CStruct._encode_into(self, buf, ofs)
+        end = ofs + len(body)
+        buf[ofs:end] = body
+        pad = self.pad_size()
+        if pad:
+            # buf may be reused, so write the padding explicitly
+            buf[end:end+pad] = _PADDING[:pad]
+        return end + pad
+
+def _index_sorted(l, x):
+    i = bisect.bisect_left(l, x)
+    while i < len(l) and not x < l[i]:
+        if l[i] == x:
+            return i
+        i += 1
+    raise ValueError(x)
 
 class TLVList:
     """ Relatively abstract base class, which has idea of having
     (sorted) 'tlvs' list of sub-TLVs, and either {add,remove} or set
-    functionality for it + convenience getter."""
+    functionality for it + convenience getter.
+
+    Typed lookups are served from an index of tlvs by class. It is
+    built lazily for the current tlvs list, and kept up to date by
+    _insert_tlv/_delete_tlv; assigning a new tlvs list invalidates
+    it. """
+    __slots__ = ()
     tlvs = None
+    _tlv_index = None # (tlvs, {class: sorted list of its instances})
     def get_tlv_matching(self, fun):
         return [tlv for tlv in self.get_tlvs() if fun(tlv)]
     def get_tlv_instances(self, cl):
+        index = self._get_tlv_index()
+        match = [k for k in index.keys() if issubclass(k, cl)]
+        if not match:
+            return []
+        if len(match) == 1:
+            return list(index[match[0]])
+        # Several classes; preserve the order of tlvs
         return self.get_tlv_matching(lambda tlv:isinstance(tlv, cl))
     def get_tlvs(self):
         if not self.tlvs: return []
         return self.tlvs
+    def index_tlv(self, x):
+        """ Like tlvs.index(x), but uses the fact that tlvs is sorted. """
+        return _index_sorted(self.tlvs or [], x)
     def has_tlv(self, x):
         if not self.tlvs: return
         try:
-            i = self.tlvs.index(x)
+            i = self.index_tlv(x)
             return self.tlvs[i]
         except ValueError:
             pass
@@ -151,40 +307,100 @@ class TLVList:
         raise NotImplementedError
     def set_tlvs(self, l):
         raise NotImplementedError
+    def _get_tlv_index(self):
+        ti = self._tlv_index
+        if ti is None or ti[0] is not self.tlvs:
+            index = {}
+            for tlv in self.get_tlvs():
+                index.setdefault(tlv.__class__, []).append(tlv)
+            ti = (self.tlvs, index)
+            self._tlv_index = ti
+        return ti[1]
+    def _insert_tlv(self, x):
+        if self.tlvs is None: self.tlvs = []
+        bisect.insort(self.tlvs, x)
+        ti = self._tlv_index
+        if ti is not None and ti[0] is self.tlvs:
+            bisect.insort(ti[1].setdefault(x.__class__, []), x)
+    def _delete_tlv(self, x):
+        del self.tlvs[self.index_tlv(x)] # ValueError if not there
+        ti = self._tlv_index
+        if ti is not None and ti[0] is self.tlvs:
+            l = ti[1][x.__class__]
+            del l[_index_sorted(l, x)]
+            if not l:
+                del ti[1][x.__class__]
 
 class ParentedTLVList(TLVList):
+    __slots__ = ()
     def add_tlv(self, x):
         ox = self.has_tlv(x)
         if ox is not None: return ox
-        if self.tlvs is None: self.tlvs = []
         parent = self.parent
         if parent is not None: parent.remove_tlv(self)
         self.body = None
-        bisect.insort(self.tlvs, x)
+        self._insert_tlv(x)
+        if isinstance(x, ContainerTLV): x.parent = self
         if parent is not None: parent.add_tlv(self)
+        return x
     def remove_tlv(self, x):
         parent = self.parent
         if parent is not None: parent.remove_tlv(self)
-        self.tlvs.remove(x)
+        if isinstance(x, ContainerTLV): x.parent = None
+        self._delete_tlv(x)
         self.body = None
         if parent is not None: parent.add_tlv(self)
 
 
 class ContainerTLV(PadBodyTLV, ParentedTLVList):
+    """ TLV which contains other TLVs.
+
+    The encodings of the children are kept around (in tlvs order),
+    so that adding or removing a child encodes only that child; the
+    rest of the cost is moving list pointers, and joining the body
+    (once, when it is needed again). The body itself is still rebuilt
+    (and e.g. SHSPAuth rehashes it) in full. Like the TLV index, the
+    segments are valid only for the tlvs list they were built from.
+    """
+    __slots__ = ['tlvs', 'parent', '_tlv_index', '_segments']
     body = None
+    tlvs = None
     parent = None
+    _tlv_index = None
+    _segments = None
+    transient = ('_tlv_index', '_segments')
     arkeys = ['tlvs'] # we can ignore 'body', it's just impl. artifact
-    def encode(self):
+    def get_body(self):
         if self.body is None:
-            self.body = encode_tlvs(*(self.tlvs or []))
+            self.body = self.tlvs and b''.join(self._get_segments()[1]) or b''
             self.body_encoded()
-        return PadBodyTLV.encode(self)
-    def decode_buffer(self, x, ofs=0):
+        return self.body
+    def _get_segments(self):
+        sg = self._segments
+        if sg is None or sg[0] is not self.tlvs:
+            sg = (self.tlvs, [x.encode() for x in self.get_tlvs()])
+            self._segments = sg
+        return sg
+    def _insert_tlv(self, x):
+        ParentedTLVList._insert_tlv(self, x)
+        sg = self._segments
+        if sg is not None and sg[0] is self.tlvs:
+            sg[1].insert(self.index_tlv(x), x.encode())
+    def _delete_tlv(self, x):
+        sg = self._segments
+        if sg is not None and sg[0] is self.tlvs:
+            del sg[1][self.index_tlv(x)]
+        ParentedTLVList._delete_tlv(self, x)
+    def decode_buffer(self, x, ofs=0, reuse=None):
+        # reuse: see decode_tlvs_reusing
         PadBodyTLV.decode_buffer(self, x, ofs)
         self.body_decoded()
-        self.tlvs = list(decode_tlvs(self.body))
-        if not self.tlvs:
-            del self.tlvs
+        if reuse:
+            self.tlvs = list(decode_tlvs_reusing(self.body, reuse)) or None
+        else:
+            self.tlvs = list(decode_tlvs(self.body)) or None
+    def get_tlv_map(self):
+        return tlv_map(self.get_body(), self.get_tlvs())
     def body_encoded(self):
         pass
     def body_decoded(self):
@@ -215,6 +431,7 @@ class NodeState(PadBodyTLV):
     keys = TLV.keys[:] + ['node_id', 'seqno', 'age', 'hash']
 
 class Neighbor(ContainerTLV):
+    __slots__ = ['last_contact', 'trickle', 'deadline'] # used by DNCP only
     t = 8
     format = TLV.format + '4sII'
     keys = TLV.keys[:] + ['n_node_id', 'n_ep_id', 'ep_id']
@@ -226,11 +443,19 @@ class KAInterval(ContainerTLV):
 
 _tlvlist = []
 _tlvs = {}
+_codecs = {}
 
 def add_tlvs(*tlvs):
     for tlv in tlvs:
         _tlvlist.append(tlv)
         _tlvs[tlv.t] = tlv
+        _codecs[tlv.t] = tlv.get_codec()
+
+def remove_tlvs(*tlvs):
+    for tlv in tlvs:
+        _tlvlist.remove(tlv)
+        del _tlvs[tlv.t]
+        del _codecs[tlv.t]
 
 add_tlvs(ReqNetState, ReqNodeState,
          NodeEP,
@@ -239,15 +464,207 @@ add_tlvs(ReqNetState, ReqNodeState,
 
 
 
-def decode_tlvs(x):
+class TLVView:
+    """ Lazily decoded TLV within a received buffer.
+
+    Only the type and length are decoded up front; the rest of the
+    header fields are unpacked when first accessed, and body is a
+    memoryview into the original buffer. Anything else (e.g. tlvs of
+    a container) is delegated to the full TLV object, which is decoded
+    on demand by get_tlv().
+
+    The views are only valid as long as the buffer is not modified, so
+    they should not be stored; keep get_tlv() result instead. """
+    __slots__ = ['buf', 'ofs', 't', 'l', '_fields', '_tlv']
+    def __init__(self, buf, ofs, t, l):
+        self.buf = buf
+        self.ofs = ofs
+        self.t = t
+        self.l = l
+        self._fields = None
+        self._tlv = None
+    def __repr__(self):
+        return '<%s %s@%d>' % (self.__class__.__name__,
+                               self.get_class().__name__, self.ofs)
+    def __getattr__(self, k):
+        # Called only for attributes not in __slots__
+        cl = self.get_class()
+        try:
+            i = cl.keys.index(k)
+        except ValueError:
+            return getattr(self.get_tlv(), k)
+        if self._fields is None:
+            self._fields = cl.get_format().unpack_from(self.buf, self.ofs)
+        return self._fields[i]
+    @property
+    def body(self):
+        bofs = self.ofs + self.get_class().get_format().size
+        return self.buf[bofs:self.ofs + TLV_SIZE + self.l]
+    def get_class(self):
+        return _tlvs.get(self.t, PadBodyTLV)
+    def get_tlv(self):
+        if self._tlv is None:
+            self._tlv = self.get_class().decode(self.buf, self.ofs)
+        return self._tlv
+    def wire_size(self):
+        return TLV_SIZE + self.l + (PAD_TO and (-self.l % PAD_TO) or 0)
+
+def tlv_class(x):
+    """ Class of a TLV object or of the TLV behind a TLVView. """
+    if isinstance(x, TLVView):
+        return x.get_class()
+    return x.__class__
+
+def _walk_tlvs(x):
+    fmt = TLV.get_format()
     i = 0
     while i + TLV_SIZE <= len(x):
-        t = TLV.decode(x, i).t
-        tlv = _tlvs.get(t, PadBodyTLV).decode(x, i)
-        yield tlv
-        i += tlv.wire_size()
+        t, l = fmt.unpack_from(x, i)
+        if i + TLV_SIZE + l > len(x):
+            break # truncated
+        yield i, t, l
+        i += TLV_SIZE + l + (PAD_TO and (-l % PAD_TO) or 0)
+
+def decode_tlv_views(x):
+    x = memoryview(x)
+    for i, t, l in _walk_tlvs(x):
+        yield TLVView(x, i, t, l)
+
+def decode_tlvs(x):
+    default = PadBodyTLV.get_codec()
+    for i, t, l in _walk_tlvs(x):
+        yield _codecs.get(t, default).decode(x, i)
+
+def tlv_map(x, tlvs):
+    """ Map the encodings (sans padding) of TLVs in x to the
+    corresponding TLVs of tlvs, which should be x decoded. """
+    keys = [x[i:i+TLV_SIZE+l] for i, t, l in _walk_tlvs(x)]
+    if len(keys) != len(tlvs):
+        keys = [t.encode()[:TLV_SIZE+t.l] for t in tlvs]
+    return dict(zip(keys, tlvs))
+
+def decode_tlvs_reusing(x, reuse):
+    """ Like decode_tlvs, but TLVs whose encoding (sans padding) is
+    in the reuse map (see tlv_map) are not decoded; the existing TLV
+    is yielded instead. Changed containers reuse the unchanged
+    children of the old container(s) of the same class similarly. """
+    if not isinstance(x, bytes):
+        x = bytes(x)
+    default = PadBodyTLV.get_codec()
+    children = None
+    for i, t, l in _walk_tlvs(x):
+        o = reuse.get(x[i:i+TLV_SIZE+l])
+        if o is None:
+            codec = _codecs.get(t, default)
+            cl = codec.cls
+            if children is None and issubclass(cl, ContainerTLV):
+                children = {}
+                for ot in reuse.values():
+                    if isinstance(ot, ContainerTLV) and ot.tlvs:
+                        children.setdefault(ot.__class__, {}).update(ot.get_tlv_map())
+            if children and cl in children:
+                o = cl()
+                o.decode_buffer(x, i, reuse=children[cl])
+            else:
+                o = codec.decode(x, i)
+        yield o
+
+def encode_tlvs_into(buf, l, ofs=0):
+    """ Encode the TLVs in l to the (preallocated) buf starting at
+    ofs. Returns the offset just past the last TLV written. """
+    for x in l:
+        ofs = x.encode_into(buf, ofs)
+    return ofs
 
 def encode_tlvs(*l):
     if not l: return b''
-    # TBD: Is there some cross-Python-version 'more efficient' syntax?
-    return functools.reduce(operator.add, [x.encode() for x in l])
+    # Size everything first, so the TLVs can be written to a single
+    # buffer; concatenating per-TLV strings is quadratic.
+    b = bytearray(sum([x.wire_size() for x in l]))
+    ofs = encode_tlvs_into(b, l)
+    assert ofs == len(b)
+    return bytes(b)
+
+_U32 = array.array('I').itemsize == 4 and 'I' or 'L'
+
+class NodeStateBatch(Blob):
+    """ Columnar form of a run of short (body-less) NodeState TLVs,
+    such as the ones sent in response to ReqNetState.
+
+    The fields are kept in parallel columns (node_ids and hashes as
+    lists of bytes, seqnos and ages as arrays) instead of one object
+    per node. The wire format is the same as that of the
+    corresponding NodeState TLVs, so a batch can be given to
+    encode_tlvs in place of them. """
+    __slots__ = ['node_ids', 'seqnos', 'ages', 'hashes']
+    record_size = NodeState.get_format().size
+    def __init__(self, node_ids=(), seqnos=(), ages=(), hashes=()):
+        self.node_ids = list(node_ids)
+        self.seqnos = array.array(_U32, seqnos)
+        self.ages = array.array(_U32, ages)
+        self.hashes = list(hashes)
+    def __repr__(self):
+        return '<%s %d nodes>' % (self.__class__.__name__, len(self))
+    def __len__(self):
+        return len(self.node_ids)
+    def __getitem__(self, i):
+        assert isinstance(i, slice)
+        return self.__class__(self.node_ids[i], self.seqnos[i],
+                              self.ages[i], self.hashes[i])
+    @classmethod
+    def from_tlvs(cls, l):
+        l = list(l)
+        if l and isinstance(l[0], TLVView):
+            buf, ofs = l[0].buf, l[0].ofs
+            end = ofs + len(l) * cls.record_size
+            if all([isinstance(v, TLVView) and v.buf is buf and v.ofs == ofs + i * cls.record_size for i, v in enumerate(l)]):
+                # Contiguous run in a received buffer; unpack in one go
+                return cls.decode(buf[ofs:end])
+        return cls([t.node_id for t in l], [t.seqno for t in l],
+                   [t.age for t in l], [t.hash for t in l])
+    def decode_buffer(self, x, ofs=0):
+        x = memoryview(x)[ofs:]
+        x = x[:len(x) - len(x) % self.record_size]
+        recs = list(NodeState.get_format().iter_unpack(x))
+        if not recs:
+            return
+        ts, ls, node_ids, seqnos, ages, hashes = zip(*recs)
+        self.__init__(node_ids, seqnos, ages, hashes)
+    def wire_size(self):
+        return len(self) * self.record_size
+    def encode(self):
+        b = bytearray(self.wire_size())
+        self.encode_into(b)
+        return bytes(b)
+    def encode_into(self, buf, ofs=0):
+        pack_into = NodeState.get_format().pack_into
+        size = self.record_size
+        t, l = NodeState.t, size - TLV_SIZE
+        for node_id, seqno, age, h in zip(self.node_ids, self.seqnos,
+                                          self.ages, self.hashes):
+            pack_into(buf, ofs, t, l, node_id, seqno, age, h)
+            ofs += size
+        return ofs
+
+def _is_short_node_state(t):
+    if isinstance(t, TLVView):
+        return t.t == NodeState.t and t.l == NodeStateBatch.record_size - TLV_SIZE
+    return t.__class__ is NodeState and not t.body
+
+def batch_node_states(l, min_run=2):
+    """ Replace runs of (at least min_run) short NodeStates in l with
+    NodeStateBatch objects. """
+    r = []
+    run = []
+    for t in list(l) + [None]:
+        if t is not None and _is_short_node_state(t):
+            run.append(t)
+            continue
+        if len(run) >= min_run:
+            r.append(NodeStateBatch.from_tlvs(run))
+        else:
+            r.extend(run)
+        run = []
+        if t is not None:
+            r.append(t)
+    return r
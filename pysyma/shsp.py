@@ -38,13 +38,14 @@ JSON_ENCODING = 'utf-8'
 
 
 class SHSPKV(PadBodyTLV):
+    __slots__ = ['json']
     t = 789
     body = None
 
-    def encode(self):
+    def get_body(self):
         if self.body is None:
             self.body = json.dumps(self.json).encode(JSON_ENCODING)
-        return PadBodyTLV.encode(self)
+        return self.body
 
     def decode_buffer(self, x, ofs=0):
         PadBodyTLV.decode_buffer(self, x, ofs)
@@ -57,19 +58,30 @@ class SHSPKV(PadBodyTLV):
 
 
 class SHSPAuth(ContainerTLV):
+    __slots__ = ['algorithm']
     t = 790
     format = TLV.format + '16s'
     keys = TLV.keys[:] + ['hash']
-
-    def body_decoded(self):
-        h = hashlib.md5(self.key + self.body).digest()
-        if h != self.hash:
-            _error('SHSPAuth hash mismatch')
-            self.body = b''
-            self.tlvs = []
+    transient = ContainerTLV.transient + ('algorithm',)
+    # 'md5' (md5 of key + body), or 'blake2b' (keyed with key, which
+    # can be at most 64 bytes then). Only SHSP knows which one is in
+    # use, so it sets it on its own SHSPAuth, and verifies the
+    # received ones (see SHSP.profile_check_tlvs).
+    algorithm = 'md5'
+
+    def get_hash(self, algorithm=None):
+        if (algorithm or self.algorithm) == 'blake2b':
+            return hashlib.blake2b(self.body, key=self.key,
+                                   digest_size=16).digest()
+        h = hashlib.md5(self.key)
+        h.update(self.body)
+        return h.digest()
+
+    def is_valid(self, algorithm=None):
+        return self.get_hash(algorithm) == self.hash
 
     def body_encoded(self):
-        self.hash = hashlib.md5(self.key + self.body).digest()
+        self.hash = self.get_hash()
 
 
 add_tlvs(SHSPKV, SHSPAuth)
@@ -79,6 +91,11 @@ class SHSPSubscriber(dncp.Subscriber):
     def dict_update_event(self, n, od, nd):
         pass
 
+# Queued dict updates of a node coalesce to one from the first old to
+# the latest new dict
+dncp.SubscriberQueue.coalescers['dict_update_event'] = (
+    lambda a: a[0], lambda a1, a2: (a2[0], a1[1], a2[2]))
+
 
 class SHSP(dncp.HNCP, SHSPSubscriber):
     subscriber_class = SHSPSubscriber
@@ -98,18 +115,30 @@ class SHSP(dncp.HNCP, SHSPSubscriber):
             # key. Too bad.)
             if key is not None:
                 SHSPAuth.key = key
+        self.auth_hash = kw.pop('auth_hash', 'md5') # see SHSPAuth
         dncp.HNCP.__init__(self, *a, **kw)
         self.local_dict = {}
         if key is not None:
-            self.at = self.add_tlv(SHSPAuth())
+            self.at = self.add_tlv(SHSPAuth(algorithm=self.auth_hash))
         self.add_subscriber(self)
 
-    def tlv_event(self, n, tlv, event):
-        if not isinstance(tlv, SHSPKV) and not isinstance(tlv, SHSPAuth):
-            #_debug(' .. not SHSP tlv')
-            return
+    subscribed_tlv_types = (SHSPKV, SHSPAuth)
+
+    def tlv_events(self, n, added, removed):
         self.node_kv_is_dirty(n)
 
+    def profile_check_tlvs(self, n, tlvs):
+        if self.at is None:
+            return tlvs
+        old = set([id(t) for t in n.tlvs or []])
+        for t in tlvs:
+            if (isinstance(t, SHSPAuth) and t.tlvs and id(t) not in old
+                and not t.is_valid(self.auth_hash)):
+                _error('SHSPAuth hash mismatch from %s', n)
+                # The body stays, so the node data (and hash) is intact
+                t.tlvs = None
+        return tlvs
+
     def node_kv_is_dirty(self, n):
         dc = len(self.kv_dirty_nodes)
         _debug('%s node_kv_is_dirty %s [%d]', self, n, dc)
@@ -144,6 +173,7 @@ class SHSP(dncp.HNCP, SHSPSubscriber):
             for t in n.get_tlv_instances(SHSPKV):
                 yield t
         else:
+            # Invalid ones have no children (see profile_check_tlvs)
             for at in n.get_tlv_instances(SHSPAuth):
                 for t in at.get_tlv_instances(SHSPKV):
                     yield t
@@ -181,6 +211,23 @@ class SHSP(dncp.HNCP, SHSPSubscriber):
             self.local_dict[k] = nt
         self.node_kv_is_dirty(self.own_node)
 
+    def get_snapshot_tlvs(self):
+        # The key-value TLVs are stored as is; the SHSPAuth container
+        # is created by __init__ (with the current key)
+        l = [t for t in dncp.HNCP.get_snapshot_tlvs(self)
+             if not isinstance(t, (SHSPAuth, SHSPKV))]
+        return l + list(self.local_dict.values())
+
+    def restore_snapshot_tlvs(self, tlvs):
+        tlv_container = self.at or self
+        for t in tlvs:
+            if isinstance(t, SHSPKV):
+                tlv_container.add_tlv(t)
+                self.local_dict[t.json['k']] = t
+            else:
+                self.add_tlv(t)
+        self.node_kv_is_dirty(self.own_node)
+
     def set_dict(self, d, ts=None):
         d = d.copy()
         for k in set(self.local_dict.keys()).difference(set(d.keys())):
@@ -19,14 +19,21 @@ This module defines system interface that DNCP subprotocols need.
 It also describes HNCP specific one, with support for setting up HNCP
 transport.
 
+For upgrades without downtime, the sockets (and the state of the DNCP
+instances using them) can be handed over to a successor process; see
+SystemInterface.handoff and takeover.
+
 TBD:
 - convert to asyncore (it is built-in after all)
 
 """
 
+import array
+import binascii
 import enum
 import fcntl
 import ipaddress
+import json
 import logging
 import os
 import select
@@ -36,7 +43,7 @@ import sys
 import threading
 import time
 
-from . import dncp, dncp_tlv
+from . import dncp, dncp_tlv, snapshot
 
 _logger = logging.getLogger(__name__)
 _debug = _logger.debug
@@ -73,6 +80,24 @@ class Timeout:
 SISocketMode = enum.Enum('SISocketMode', 'none mc ul uc')
 
 
+MAX_HANDOFF_SOCKETS = 64
+
+_handoff_header = struct.Struct('>I') # length of the JSON that follows
+_handoff_ack = b'A' # sent by the successor once it has resumed
+
+HANDOFF_TIMEOUT = 10 # seconds to wait for the ack before resuming
+
+
+def _recv_all(conn, n, b=b''):
+    while n > 0:
+        x = conn.recv(n)
+        if not x:
+            raise ValueError('connection closed during handoff')
+        b += x
+        n -= len(x)
+    return b
+
+
 def _if_nametoindex(ifn):
     return socket.getaddrinfo('fe80::1%' + ifn, 0, socket.AF_INET6, 0)[0][4][3]
 
@@ -84,21 +109,61 @@ def _if_exists(ifn):
 class SystemInterfaceSocket(dncp.SystemInterface):
     mode = SISocketMode.none
     ep_name = None
+    if_list = ()
+    paused = False # handed off, but not acked yet (see handoff)
 
     def __init__(self, **kw):
+        self.eps = [] # created by set_dncp_*
         self.__dict__.update(kw)
         self.time = self.si.time
         self.schedule = self.si.schedule
+        self.si.sockets.append(self)
         self.si.add_reader(self.s, self.handle_read)
 
     def get_port(self):
         return self.s.getsockname()[1]
 
+    def close(self):
+        self.si.readers.pop(self.s, None)
+        self.si.sockets.remove(self)
+        self.s.close()
+
+    def pause(self, paused):
+        # While paused, the socket is neither read nor written
+        self.paused = paused
+        if paused:
+            self.si.readers.pop(self.s, None)
+        else:
+            self.si.add_reader(self.s, self.handle_read)
+
+    def get_handoff_state(self):
+        remote = None
+        if self.mode == SISocketMode.uc:
+            remote = list(self.default_dst)
+        return dict(port=self.port, mode=self.mode.name,
+                    ep_name=self.ep_name, if_list=list(self.if_list),
+                    remote=remote)
+
+    def resume(self, dncp, d):
+        # Redo what set_dncp_* did on the other side; the multicast
+        # memberships came along with the socket
+        mode = SISocketMode[d['mode']]
+        if mode == SISocketMode.mc:
+            self.set_dncp_multicast(dncp, d['if_list'],
+                                    unicast_ep_name=d['ep_name'],
+                                    join_groups=False)
+        elif mode == SISocketMode.uc:
+            self.set_dncp_unicast_connect(dncp, tuple(d['remote']))
+        elif mode == SISocketMode.ul:
+            self.set_dncp_unicast_listen(dncp, ep_name=d['ep_name'])
+
     def send(self, ep, src, dst, tlvs):
         # These sockets should have specialized sys_send due to set_dncp_*
         raise NotImplementedError
 
     def send_ll(self, ep, dst, tlvs):
+        if self.paused:
+            return
         if dst is None:
             dst = self.default_dst
         assert dst is not None
@@ -115,6 +180,8 @@ class SystemInterfaceSocket(dncp.SystemInterface):
             _error('got exception when sending multicast: %s', e)
 
     def send_u(self, src, dst, tlvs):
+        if self.paused:
+            return
         if dst is None:
             dst = self.default_dst
             if dst is None:
@@ -153,29 +220,34 @@ class SystemInterfaceSocket(dncp.SystemInterface):
             # Unicast-Listen
             ep = self.dncp.find_ep_by_name(self.ep_name)
         if ep:
-            self.dncp.ext_received(ep, src, dst, dncp_tlv.decode_tlvs(data))
+            self.dncp.ext_received(ep, src, dst,
+                                   dncp_tlv.decode_tlv_views(data))
         else:
             _debug(' no endpoint found, ignoring')
 
-    def set_dncp_multicast(self, dncp, if_list=[], unicast_ep_name=None):
+    def set_dncp_multicast(self, dncp, if_list=[], unicast_ep_name=None,
+                           join_groups=True):
         assert self.mode == SystemInterfaceSocket.mode  # default
         if unicast_ep_name:
             self.set_dncp_unicast_listen(dncp, ep_name=unicast_ep_name)
         self.mode = SISocketMode.mc
         self.dncp = dncp
+        self.if_list = list(if_list)
         self.default_dst = (self.si.proto_group, self.si.proto_port)
         addrinfo = socket.getaddrinfo(self.si.proto_group, None)[0]
         group_bin = socket.inet_pton(addrinfo[0], self.si.proto_group)
         for if_name in if_list:
             ep = dncp.create_ep(if_name)
+            self.eps.append(ep)
 
             def _send(src, dst, tlvs):
                 self.send_ll(ep, dst, tlvs)
             ep.sys_send = _send
-            ifindex = _if_nametoindex(if_name)
-            mreq = group_bin + struct.pack('@I', ifindex)
-            self.s.setsockopt(socket.IPPROTO_IPV6,
-                              socket.IPV6_JOIN_GROUP, mreq)
+            if join_groups:
+                ifindex = _if_nametoindex(if_name)
+                mreq = group_bin + struct.pack('@I', ifindex)
+                self.s.setsockopt(socket.IPPROTO_IPV6,
+                                  socket.IPV6_JOIN_GROUP, mreq)
             ep.ext_ready(True)
 
     def set_dncp_unicast_connect(self, dncp, remote):
@@ -188,6 +260,7 @@ class SystemInterfaceSocket(dncp.SystemInterface):
                             sys_send=self.send_u,
                             per_endpoint_ka=True,
                             per_peer_ka=False)
+        self.eps.append(ep)
         ep.ext_ready(True)
 
     def set_dncp_unicast_listen(self, dncp, ep_name='listen'):
@@ -200,6 +273,7 @@ class SystemInterfaceSocket(dncp.SystemInterface):
         ep = dncp.create_ep(ep_name, sys_send=self.send_u,
                             per_endpoint_ka=False,
                             per_peer_ka=True)
+        self.eps.append(ep)
         ep.ext_ready(True)
 
 
@@ -212,6 +286,7 @@ class SystemInterface:
     def __init__(self):
         self.timeouts = []
         self.readers = {}
+        self.sockets = []
         r, w = os.pipe()
         fl = fcntl.fcntl(r, fcntl.F_GETFL)
         fcntl.fcntl(r, fcntl.F_SETFL, fl | os.O_NONBLOCK)
@@ -269,7 +344,10 @@ class SystemInterface:
             (rlist, wlist, xlist) = select.select(k, [], [], to)
             _debug('readable %s', rlist)
             for fd in rlist:
-                self.readers[fd]()
+                # (An earlier callback may have removed it)
+                cb = self.readers.get(fd)
+                if cb is not None:
+                    cb()
         if to is not None and to in self.timeouts:
             self.timeouts.remove(to)
         del self.current_thread
@@ -320,6 +398,107 @@ class SystemInterface:
     def set_locked(self, locked):
         pass
 
+    def handoff(self, conn, sockets=None, cb=None, timeout=HANDOFF_TIMEOUT):
+        """ Hand the sockets (default: all) over to a successor
+        process (see takeover) through conn, a connected AF_UNIX
+        socket, together with the state of their DNCP instances.
+
+        The sockets are paused until the successor acks (in the
+        loop); then their endpoints are disabled, and the sockets are
+        closed here. If no ack arrives within timeout (or conn is
+        closed), they are resumed here instead. cb, if given, is
+        called with True or False accordingly. """
+        if sockets is None:
+            sockets = self.sockets
+        sockets = list(sockets)
+        dncps = []
+        sl = []
+        for sis in sockets:
+            if sis.dncp not in dncps:
+                dncps.append(sis.dncp)
+            d = sis.get_handoff_state()
+            d['dncp'] = dncps.index(sis.dncp)
+            sl.append(d)
+        dl = []
+        for p in dncps:
+            p._flush_sends()
+            b = snapshot.encode(p)
+            dl.append(dict(snapshot=binascii.b2a_hex(b).decode('ascii'),
+                           runtime=snapshot.get_runtime_state(p)))
+        b = json.dumps(dict(sockets=sl, dncps=dl)).encode('utf-8')
+        fds = array.array('i', [sis.s.fileno() for sis in sockets])
+        conn.sendmsg([_handoff_header.pack(len(b))],
+                     [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+        conn.sendall(b)
+        for sis in sockets:
+            sis.pause(True)
+
+        def _done(ok):
+            del self.readers[conn]
+            for sis in sockets:
+                if not ok:
+                    sis.pause(False)
+                    continue
+                for ep in sis.eps:
+                    ep.ext_ready(False)
+                sis.close()
+            if not ok:
+                _error('handoff not acked, resuming')
+            if cb is not None:
+                cb(ok)
+
+        def _read():
+            try:
+                x = conn.recv(len(_handoff_ack))
+            except socket.error:
+                x = None
+            to.cancel()
+            _done(x == _handoff_ack)
+        to = self.schedule(timeout, _done, False)
+        self.add_reader(conn, _read)
+
+    def takeover(self, conn, proto_class, **kw):
+        """ Receive what handoff sent through conn, and resume the DNCP
+        instances (created with proto_class(sys=.., **kw)) as they
+        were, and ack the handoff. Returns the instances. """
+        fds = array.array('i')
+        size = socket.CMSG_SPACE(MAX_HANDOFF_SOCKETS * fds.itemsize)
+        b, ancdata, flags, addr = conn.recvmsg(_handoff_header.size, size)
+        for level, t, data in ancdata:
+            if level == socket.SOL_SOCKET and t == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+        b = _recv_all(conn, _handoff_header.size - len(b), b)
+        b = _recv_all(conn, _handoff_header.unpack(b)[0])
+        state = json.loads(b.decode('utf-8'))
+        sl = state['sockets']
+        if len(fds) != len(sl):
+            for fd in fds:
+                os.close(fd)
+            raise ValueError('got %d sockets, expected %d' % (len(fds),
+                                                              len(sl)))
+        sockets = [SystemInterfaceSocket(s=socket.socket(fileno=fd), si=self,
+                                         port=d['port'])
+                   for fd, d in zip(fds, sl)]
+        try:
+            dncps = []
+            for i, d in enumerate(state['dncps']):
+                l = [(sis, sd) for sis, sd in zip(sockets, sl)
+                     if sd['dncp'] == i]
+                p = proto_class(sys=l[0][0], **kw)
+                for sis, sd in l:
+                    sis.resume(p, sd)
+                nsl, tlvs = snapshot.decode(p, binascii.a2b_hex(d['snapshot']))
+                snapshot.restore(p, nsl, tlvs, republish=False)
+                snapshot.set_runtime_state(p, d['runtime'])
+                dncps.append(p)
+        except:
+            # No ack; the predecessor carries on with the sockets
+            for sis in sockets:
+                sis.close()
+            raise
+        conn.sendall(_handoff_ack)
+        return dncps
+
 
 class HNCPSystemInterface(SystemInterface):
     proto_group = 'ff02::11'
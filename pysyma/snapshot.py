@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- Python -*-
+#
+# $Id: snapshot.py $
+#
+# Author: Markus Stenberg <fingon@iki.fi>
+#
+# Copyright (c) 2026 Markus Stenberg
+#
+# Created:       Sat Oct 17 21:12:40 2026 mstenber
+# Last modified: Sat Oct 17 21:12:40 2026 mstenber
+# Edit time:     0 min
+#
+"""
+
+Snapshot of DNCP state for warm restarts.
+
+The file consists of a header, and then TLVs: NodeStates (with body)
+of the valid nodes, own node first, and then the local TLVs that
+should be restored (see DNCP.get_snapshot_tlvs).
+
+On load, the own node id and seqno are reused (the next publish
+bumps the seqno, so peers will pick it up), and the other nodes are
+restored as they were, once their hashes have been verified. They
+are unreachable until our neighbors show up again, and then only the
+network hash (and our own node) needs to be exchanged.
+
+"""
+
+import binascii
+import os
+import struct
+
+from pysyma.dncp_tlv import NodeState, Neighbor, encode_tlvs, decode_tlvs
+from pysyma.dncp import Dirty
+
+import logging
+_logger = logging.getLogger(__name__)
+_debug = _logger.debug
+_error = _logger.error
+
+MAGIC = b'PSYS'
+VERSION = 1
+
+# magic, version, node id length, hash length, # of NodeStates
+_header = struct.Struct('>4sBBBxI')
+
+
+def encode(dncp):
+    dncp._flush_local()
+    own = dncp.own_node
+    nodes = [own] + [n for n in dncp.valid_sorted_nodes() if n is not own]
+    l = [n._get_ns(short=False) for n in nodes]
+    return (_header.pack(MAGIC, VERSION, dncp.NODE_ID_LENGTH,
+                         dncp.HASH_LENGTH, len(l)) +
+            encode_tlvs(*(l + list(dncp.get_snapshot_tlvs()))))
+
+
+def save(dncp, filename):
+    """ Write the snapshot atomically; either the old or the new one
+    will be there after a crash. """
+    b = encode(dncp)
+    tmp = '%s.tmp' % filename
+    with open(tmp, 'wb') as f:
+        f.write(b)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
+def decode(dncp, x):
+    """ Returns (NodeStates, local TLVs) of the snapshot x; raises
+    ValueError if it is not one (for this profile). """
+    if len(x) < _header.size:
+        raise ValueError('snapshot too short')
+    magic, version, id_len, hash_len, count = _header.unpack_from(x)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a snapshot (version %d)' % VERSION)
+    if id_len != dncp.NODE_ID_LENGTH or hash_len != dncp.HASH_LENGTH:
+        raise ValueError('snapshot of a different profile')
+    tlvs = list(decode_tlvs(x[_header.size:]))
+    nsl, tlvs = tlvs[:count], tlvs[count:]
+    if len(nsl) != count or [ns for ns in nsl if not isinstance(ns, NodeState)]:
+        raise ValueError('snapshot truncated')
+    if not nsl or dncp.profile_hash(nsl[0].body) != nsl[0].hash:
+        raise ValueError('own node state corrupted')
+    return nsl, tlvs
+
+
+def restore(dncp, nsl, tlvs, republish=True):
+    """ Restore the decoded snapshot. If republish is False (the
+    sender is still running, and hands over to us), the own node is
+    published as is, unless the local TLVs differ from it. """
+    own = nsl[0]
+    _debug('%s restoring %d nodes', dncp, len(nsl))
+    now = dncp.sys.time()
+    n = dncp.set_node_id(own.node_id)
+    body = bytes(own.body)
+    n.set_tlvs(decode_tlvs(body), data=body)
+    n.seqno = own.seqno
+    n.origination_time = now - own.age / 1000.0
+    dncp.restore_snapshot_tlvs(tlvs)
+    if republish:
+        dncp.schedule_immediate_dirty(Dirty.local_always)
+    for ns in nsl[1:]:
+        n = dncp.find_or_create_node_by_id(ns.node_id)
+        n._update_from_ns(ns) # verifies the hash
+        if not n.tlvs:
+            dncp.remove_node(n)
+            continue
+        # Grace period starts now, not when we went down
+        n.last_reachable = now
+
+
+def _get_trickle_state(t):
+    return dict(i=t.i, c=t.c, send_time=t.send_time,
+                interval_end_time=t.interval_end_time, last_sent=t.last_sent)
+
+
+def get_runtime_state(dncp):
+    """ What a successor process needs in addition to the snapshot
+    to carry on as dncp: endpoints, neighbors and their timers (as
+    JSON friendly structure). The times are absolute, so the clock
+    must be shared (i.e. same host). """
+    eps = [[ep.name, ep.ep_id,
+            ep.per_endpoint_ka and _get_trickle_state(ep.trickle) or None]
+           for ep in dncp.id2ep.values()]
+    neighbors = []
+    for t in dncp.get_tlv_instances(Neighbor):
+        tr = getattr(t, 'trickle', None)
+        neighbors.append([binascii.b2a_hex(t.n_node_id).decode('ascii'),
+                          t.n_ep_id, t.ep_id, t.last_contact,
+                          tr and list(tr.addrs) or None,
+                          tr and _get_trickle_state(tr) or None])
+    return dict(endpoints=eps, neighbors=neighbors)
+
+
+def set_runtime_state(dncp, d):
+    """ Counterpart of get_runtime_state; the endpoints must have been
+    created (with the same ids) already. """
+    for name, ep_id, ts in d['endpoints']:
+        ep = dncp.find_ep_by_name(name)
+        if ep is None or ep.ep_id != ep_id:
+            raise ValueError('endpoint %s[%d] mismatch' % (name, ep_id))
+        if ts and ep.per_endpoint_ka:
+            ep.trickle.__dict__.update(ts)
+    for nid, n_ep_id, ep_id, last_contact, addrs, ts in d['neighbors']:
+        src, dst = [a is not None and tuple(a) or None
+                    for a in addrs or (None, None)]
+        t = dncp._add_neighbor(dncp.id2ep[ep_id], src, dst,
+                               binascii.a2b_hex(nid), n_ep_id,
+                               last_contact=last_contact)
+        if ts and getattr(t, 'trickle', None):
+            t.trickle.__dict__.update(ts)
+
+
+def load(dncp, filename):
+    """ Restore the snapshot in filename to (freshly created) dncp. """
+    with open(filename, 'rb') as f:
+        nsl, tlvs = decode(dncp, f.read())
+    restore(dncp, nsl, tlvs)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- Python -*-
+#
+# $Id: watch.py $
+#
+# Author: Markus Stenberg <fingon@iki.fi>
+#
+# Copyright (c) 2026 Markus Stenberg
+#
+# Created:       Sat Oct 17 22:41:05 2026 mstenber
+# Last modified: Sat Oct 17 22:41:05 2026 mstenber
+# Edit time:     0 min
+#
+"""
+
+Streaming of DNCP state changes as JSON lines (see hncptool --watch).
+
+Each line is an object with event, node (id in hex) and time, and
+depending on the event:
+
+node: op (add/remove)
+
+tlv: op (add/remove), type, and tlv (the encoding in hex)
+
+seqno: seqno, and old_seqno (null if not seen before)
+
+"""
+
+import binascii
+import json
+import sys
+import time
+
+from pysyma.dncp import Subscriber, NodeEvent
+
+
+def _hex(b):
+    return binascii.b2a_hex(b).decode('ascii')
+
+
+class WatchSubscriber(Subscriber):
+    """ Writes the node and TLV changes as JSON lines to out. """
+    def __init__(self, out=sys.stdout, tlv_types=None, time=time.time):
+        self.out = out
+        self.tlv_types = tlv_types and set(tlv_types) or None
+        self.time = time
+        self.seqnos = {} # node => last seqno written
+
+    def write(self, event, n, **kw):
+        if n.is_self():
+            return # e.g. hncptool's read-only node; not interesting
+        kw.update(event=event, node=_hex(n.node_id), time=self.time())
+        self.out.write(json.dumps(kw, sort_keys=True) + '\n')
+        self.out.flush()
+
+    def node_event(self, n, event):
+        if event == NodeEvent.add:
+            self.write('node', n, op='add')
+        else:
+            self.seqnos.pop(n, None)
+            self.write('node', n, op='remove')
+
+    def tlv_events(self, n, added, removed):
+        for op, l in [('remove', removed), ('add', added)]:
+            for t in sorted(l):
+                if self.tlv_types is None or t.t in self.tlv_types:
+                    self.write('tlv', n, op=op, type=t.t,
+                               tlv=_hex(t.encode()))
+
+    def node_update_event(self, n):
+        old = self.seqnos.get(n)
+        if old == n.seqno:
+            return
+        self.seqnos[n] = n.seqno
+        self.write('seqno', n, seqno=n.seqno, old_seqno=old)
@@ -30,6 +30,8 @@ setup(name=NAME,
       author = 'Markus Stenberg',
       author_email = 'fingon+%s@iki.fi' % NAME,
       packages = find_packages(),
-      install_requires=['enum34', 'ipaddress']
+      # Python 3 only (class keyword arguments, bytes semantics, ..);
+      # enum and ipaddress are in the standard library there
+      python_requires='>=3.7',
       )
 
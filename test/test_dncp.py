@@ -16,6 +16,9 @@
 
 """
 
+import copy
+import pickle
+
 import pysyma.dncp
 from pysyma.dncp_tlv import *
 
@@ -54,11 +57,206 @@ def test_tlv():
         tl = list(decode_tlvs(t.encode()))
         assert len(tl) == 1
         assert tl[0] == t
-        assert tl[0].__dict__ == t.__dict__
+        assert tl[0].__getstate__() == t.__getstate__()
         assert t.copy() == t
     tl = list(decode_tlvs(encode_tlvs(*test_material)))
     assert tl == test_material
     assert not tl[0].l
 
+def test_tlv_slots():
+    t = Neighbor(n_node_id=b'barb', n_ep_id=42, ep_id=7)
+    assert not hasattr(t, '__dict__')
+    assert t.t == Neighbor.t == 8
+    assert t.tlvs is None and t.body is None
+    t.last_contact = 1
+    assert t.copy() == t and t.copy().last_contact == 1
+    # Non-empty containers survive copying and pickling (the
+    # transient slots are not part of the state)
+    t.add_tlv(PadBodyTLV(t=42, body=b'foo'))
+    b = t.encode()
+    for t2 in [copy.copy(t), copy.deepcopy(t),
+               pickle.loads(pickle.dumps(t))]:
+        assert t2.encode() == b
+        assert t2.get_tlv_instances(PadBodyTLV) == [PadBodyTLV(t=42, body=b'foo')]
+    try:
+        t.foo = 1
+        assert False
+    except AttributeError:
+        pass
+
+def test_tlv_cache():
+    t = NodeEP(node_id=b'foob', ep_id=123)
+    b = t.encode()
+    assert t.encode() is b
+    t.ep_id = 124
+    assert t.encode() != b
+    assert NodeEP.decode(t.encode()) == t
+    c = ReqNetState()
+    c.add_tlv(PadBodyTLV(t=42, body=b'x'))
+    b = c.encode()
+    c.add_tlv(PadBodyTLV(t=41))
+    assert c.encode() != b
+    assert c.index_tlv(PadBodyTLV(t=41)) == 0
+    l = [PadBodyTLV(t=42, body=str(i).encode()) for i in range(1000)]
+    assert len(set([hash(t) for t in l])) > 900
+    assert sorted(reversed(l)) == sorted(l)
+
+def test_tlv_index():
+    c = ReqNetState()
+    assert c.get_tlv_instances(Neighbor) == []
+    n1 = Neighbor(n_node_id=b'barb', n_ep_id=42, ep_id=7)
+    n2 = Neighbor(n_node_id=b'barb', n_ep_id=41, ep_id=7)
+    k = KAInterval(ep_id=42, interval=12345)
+    for t in [n1, k, n2]:
+        c.add_tlv(t)
+    assert c.get_tlv_instances(Neighbor) == [n2, n1]
+    assert c.get_tlv_instances(KAInterval) == [k]
+    assert c.get_tlv_instances(ContainerTLV) == c.tlvs
+    c.remove_tlv(n2)
+    assert c.get_tlv_instances(Neighbor) == [n1]
+    c.remove_tlv(k)
+    assert c.get_tlv_instances(KAInterval) == []
+    # Replacing the list invalidates the index
+    c.tlvs = [n2]
+    assert c.get_tlv_instances(Neighbor) == [n2]
+
+class CountingCodec(CStructCodec):
+    decoded = 0
+    def decode(self, x, ofs=0):
+        CountingCodec.decoded += 1
+        return CStructCodec.decode(self, x, ofs)
+
+class CodecTestTLV(PadBodyTLV):
+    t = 4242
+    format = TLV.format + 'I'
+    keys = TLV.keys[:] + ['x']
+    codec_class = CountingCodec
+
+def test_tlv_codec():
+    add_tlvs(CodecTestTLV)
+    try:
+        t = CodecTestTLV(x=42, body=b'foo')
+        assert isinstance(CodecTestTLV.get_codec(), CountingCodec)
+        assert NodeState.get_codec() is not PadBodyTLV.get_codec()
+        tl = list(decode_tlvs(encode_tlvs(t, t)))
+        assert tl == [t, t]
+        assert CountingCodec.decoded == 2
+    finally:
+        remove_tlvs(CodecTestTLV)
+    # Unregistered, it decodes as any unknown TLV
+    assert list(decode_tlvs(encode_tlvs(t)))[0].__class__ is PadBodyTLV
+
+def test_tlv_views():
+    l = [PadBodyTLV(t=67, body=b'xxx'),
+         NodeState(node_id=b'foob', seqno=123, age=234,
+                   hash=b'12345678', body=b'x'),
+         Neighbor(n_node_id=b'barb', n_ep_id=42, ep_id=7),
+         ReqNetState(tlvs=[PadBodyTLV(t=123)])]
+    b = encode_tlvs(*l)
+    vl = list(decode_tlv_views(b))
+    assert len(vl) == len(l)
+    for v, t in zip(vl, l):
+        assert tlv_class(v) is tlv_class(t)
+        for k in t.keys:
+            assert getattr(v, k) == getattr(t, k)
+        assert v.body == t.body
+        assert v.get_tlv() == t
+    assert vl[-1].tlvs == l[-1].tlvs
+    # Truncated TLVs are ignored
+    assert len(list(decode_tlv_views(b[:-1]))) == len(l) - 1
+
+def test_node_state_batch():
+    l = [NodeState(node_id=b'%04d' % i, seqno=i, age=3, hash=b'12345678')
+         for i in range(5)]
+    b = encode_tlvs(*l)
+    assert NodeStateBatch.from_tlvs(l).encode() == b
+    ns = NetState(hash=b'abcdefgh')
+    r = batch_node_states(decode_tlv_views(b + ns.encode()))
+    assert len(r) == 2
+    assert r[0].node_ids == [t.node_id for t in l]
+    assert list(r[0].seqnos) == [t.seqno for t in l]
+    assert r[0].encode() == b
+    assert r[1].get_tlv() == ns
+    # Runs broken by full NodeStates are not merged
+    l[2].body = b'x'
+    r = batch_node_states(l)
+    assert [len(x) for x in r if isinstance(x, NodeStateBatch)] == [2, 2]
+    assert r[1] is l[2]
+
+def test_encode_into():
+    l = [PadBodyTLV(t=65, body=b'x'),
+         NodeEP(node_id=b'foob', ep_id=123),
+         ReqNetState(tlvs=[PadBodyTLV(t=66, body=b'xx')])]
+    b = encode_tlvs(*l)
+    assert b == b''.join([t.encode() for t in l])
+    # Reused buffers must not leak old content through the padding
+    buf = bytearray(b'\xff' * (len(b) + 3))
+    assert encode_tlvs_into(buf, l, 3) == len(buf)
+    assert buf[3:] == b
+    assert list(decode_tlvs(bytes(buf[3:]))) == l
+
+def test_container_segments():
+    outer = ReqNetState()
+    inner = NodeEP(node_id=b'foob', ep_id=1)
+    outer.add_tlv(inner)
+    assert inner.parent is outer
+    l = [PadBodyTLV(t=65 + i, body=b'x' * i) for i in range(10)]
+    for t in l[::2] + l[1::2]:
+        inner.add_tlv(t)
+    for t in l[3:7]:
+        inner.remove_tlv(t)
+    tlvs = l[:3] + l[7:]
+    assert inner.tlvs == tlvs
+    assert inner.get_body() == encode_tlvs(*tlvs)
+    # Change within nested container is reflected in the outer one
+    ref = ReqNetState(tlvs=[NodeEP(node_id=b'foob', ep_id=1, tlvs=tlvs)])
+    assert outer.encode() == ref.encode()
+    assert list(decode_tlvs(outer.encode())) == [ref]
+    outer.remove_tlv(inner)
+    assert inner.parent is None
+
+
+def test_decode_tlvs_reusing():
+    kids = [PadBodyTLV(t=66, body=b'x' * i) for i in range(5)]
+    l = [PadBodyTLV(t=65, body=b'a'),
+         PadBodyTLV(t=65, body=b'bb'),
+         ReqNetState(tlvs=kids)]
+    b = encode_tlvs(*l)
+    old = list(decode_tlvs(b))
+    reuse = tlv_map(b, old)
+    assert len(reuse) == 3
+    nl = [l[0], PadBodyTLV(t=65, body=b'cc'),
+          ReqNetState(tlvs=kids[:2] + [PadBodyTLV(t=67)] + kids[3:])]
+    new = list(decode_tlvs_reusing(encode_tlvs(*nl), reuse))
+    assert new == nl
+    assert new[0] is old[0]
+    assert new[1] is not old[1]
+    # Changed container, but its unchanged children are reused
+    assert new[2] is not old[2]
+    for i in [0, 1, 3, 4]:
+        assert new[2].tlvs[i] is old[2].tlvs[i]
+    assert new[2].tlvs[2] == PadBodyTLV(t=67)
+
+def test_bench_codec():
+    import pysyma.bench
+    from pysyma.shsp import SHSPAuth
+    key = getattr(SHSPAuth, 'key', None)
+    r = list(pysyma.bench.bench_codec(counts=(3,), sizes=(4,), min_time=0))
+    assert [x['name'] for x in r] == ['encode_tlvs', 'decode_tlvs',
+                                      'blob_sort', 'blob_eq',
+                                      'container_encode',
+                                      'shspkv_encode', 'shspkv_decode',
+                                      'shspauth_hash']
+    assert all(x['ns_per_op'] > 0 for x in r)
+    assert getattr(SHSPAuth, 'key', None) == key
+
+def test_bench_hash():
+    import pysyma.bench
+    r = list(pysyma.bench.bench_hash(sizes=(10,), min_time=0))
+    assert set([x['name'] for x in r]) == set(['md5/8', 'sha256/8', 'blake2b/8',
+                                               'shspauth-md5',
+                                               'shspauth-blake2b'])
+
+
 if __name__ == '__main__':
     test_tlv()
@@ -27,8 +27,18 @@ equality operation of arbitrary instances does apply)
 
 """
 
+import hashlib
+import io
+import json
+import pytest
+import struct
+import threading
+
 import pysyma.dncp
 from pysyma.dncp_tlv import *
+from pysyma.dncp import TLVEvent
+import pysyma.snapshot
+import pysyma.watch
 from net_sim import DummyNode, DummySystem, setup_tube, LOOP_SELF
 
 
@@ -50,6 +60,255 @@ def test_hncp_tube():
     s, nodes = setup_tube(10)
     s.run_until(s.is_converged, time_ceiling=30) # much too 'big'
 
+class BatchHNCP(pysyma.dncp.HNCP):
+    BATCH_NODE_STATES = True
+
+def test_hncp_batch():
+    s, nodes = setup_tube(10, proto=BatchHNCP)
+    s.run_until(s.is_converged, time_ceiling=30) # much too 'big'
+
+def test_hncp_blake2b():
+    s, nodes = setup_tube(3, proto=lambda k:pysyma.dncp.HNCP(k, HASH_ALGORITHM='blake2b'))
+    s.run_until(s.is_converged, time_ceiling=30)
+    h = nodes[1].h
+    n0 = h.id2node[nodes[0].h.own_node.node_id]
+    assert n0.get_node_hash() == hashlib.blake2b(n0.get_node_data(), digest_size=8).digest()
+    # Received node data is adopted as is
+    assert n0.get_node_data() == nodes[0].h.own_node.get_node_data()
+    assert n0.get_node_hash() == nodes[0].h.own_node.get_node_hash()
+
+class LimitedRNSHNCP(pysyma.dncp.HNCP):
+    RNS_INFLIGHT_LIMIT = 3
+
+def test_hncp_rns_limit():
+    s, nodes = setup_tube(12)
+    s.run_until(s.is_converged, time_ceiling=30)
+    s.proto = LimitedRNSHNCP
+    node = s.add_node()
+    h = node.h
+    inflight = []
+    def _request_node_states(ep, src, dst, node_ids, f=h._request_node_states):
+        f(ep, src, dst, node_ids)
+        r = h.node_state_requests.get((ep, src))
+        inflight.append(r and len(r.inflight) or 0)
+    h._request_node_states = _request_node_states
+    e = nodes[0].ep('up')
+    sent = []
+    def _sys_send(src, dst, l, f=e.sys_send):
+        sent.append(l)
+        f(src, dst, l)
+    e.sys_send = _sys_send
+    s.set_connected(node.ep('up'), e)
+    s.run_until(s.is_converged, time_ceiling=30)
+    assert max(inflight) == 3
+    assert not h.node_state_requests
+    # Responses to the (up to 3) requests are packed together
+    assert max([len([t for t in p if isinstance(t, NodeState) and t.body])
+                for p in sent]) > 1
+
+def test_hncp_rns_prune():
+    s, nodes = setup_tube(2)
+    s.run_until(s.is_converged, time_ceiling=10)
+    h = nodes[0].h
+    e = nodes[0].ep('down')
+    # A peer that never answers
+    h._request_node_states(e, 'gone', None, [b'abcd', b'efgh'])
+    assert (e, 'gone') in h.node_state_requests
+    s.run_seconds(h.RNS_TIMEOUT * 2)
+    assert not h.node_state_requests
+    # Nor do they outlive the endpoint
+    h._request_node_states(e, 'gone', None, [b'abcd'])
+    e.ext_ready(False)
+    assert not h.node_state_requests
+
+class PacedHNCP(pysyma.dncp.HNCP):
+    PACE_EP_BYTES = 3000
+    PACE_DST_PACKETS = 20
+    PACE_MAX_DEFERRED = 4
+
+def test_hncp_pacing():
+    s, nodes = setup_tube(8, proto=PacedHNCP)
+    for i, node in enumerate(nodes):
+        node.h.add_tlv(PadBodyTLV(t=42, body=b'%d' % i * 1000))
+    s.run_until(s.is_converged, time_ceiling=60)
+    pacers = [ep.packetizer.pacer for node in nodes
+              for ep in node.h.name2ep.values()]
+    assert sum([p.deferred for p in pacers]) > 0
+    assert not [p for p in pacers if p.queues]
+    # Unpaced by default
+    s2, nodes2 = setup_tube(2)
+    assert nodes2[0].ep('up').packetizer.pacer is None
+
+def test_hncp_pacer_drop():
+    s = DummySystem(proto=PacedHNCP)
+    node = s.add_node()
+    h = node.h
+    e = node.ep('eth0')
+    sent = []
+    e.sys_send = lambda src, dst, l: sent.append(l)
+    pacer = e.packetizer.pacer
+    ns = NodeState(node_id=b'foob', seqno=1, age=0, hash=b'12345678',
+                   body=b'x' * 100)
+    for i in range(30):
+        e.send(None, 'dst', [ns])
+        e.packetizer.flush()
+    e.send(None, 'dst', [NetState(hash=b'12345678')])
+    e.packetizer.flush()
+    # Budget of 20 packets; the NetState goes out anyway
+    assert len(sent) == 21
+    assert isinstance(sent[-1][-1], NetState)
+    assert pacer.overdrafts == 1
+    assert pacer.deferred == 10
+    assert pacer.dropped == 6
+    s.run_seconds(1)
+    assert len([p for p in sent if pacer.is_bulk(p)]) == 24
+    assert not pacer.queues
+    # Idle (and refilled) per-destination buckets are forgotten
+    assert 'dst' in pacer.dst_buckets
+    s.run_seconds(h.PACE_BURST * 2)
+    e.send(None, 'dst2', [NetState(hash=b'12345678')])
+    e.packetizer.flush()
+    assert 'dst' not in pacer.dst_buckets and 'dst2' in pacer.dst_buckets
+
+class TightPacedHNCP(pysyma.dncp.HNCP):
+    PACE_DST_PACKETS = 2
+    PACE_MAX_DEFERRED = 1
+
+def test_hncp_pacer_mixed():
+    s = DummySystem(proto=TightPacedHNCP)
+    node = s.add_node()
+    e = node.ep('eth0')
+    sent = []
+    e.sys_send = lambda src, dst, l: sent.append(l)
+    pacer = e.packetizer.pacer
+    ns = NodeState(node_id=b'foob', seqno=1, age=0, hash=b'12345678',
+                   body=b'x' * 100)
+    for i in range(5):
+        # Same tick; merged by the Packetizer, but not in one packet
+        e.send(None, 'dst', [ns])
+        e.send(None, 'dst', [NetState(hash=b'12345678')])
+        e.packetizer.flush()
+    # Every NetState went out, right away
+    assert len([p for p in sent if isinstance(p[-1], NetState)]) == 5
+    assert not [p for p in sent if pacer.is_bulk(p) and
+                [t for t in p if isinstance(t, NetState)]]
+    # Budget of 2 packets: the first NetState and NodeState; of the
+    # 4 NodeStates deferred, only the newest one is kept
+    assert pacer.overdrafts == 4
+    assert pacer.deferred == 4 and pacer.dropped == 3
+
+def test_hncp_trickle_reset():
+    s, nodes = setup_tube(2)
+    s.run_until(s.is_converged, time_ceiling=3)
+    h = nodes[0].h
+    t = nodes[0].ep('up').trickle
+    t.set_i(0)
+    st = t.send_time
+    s.run_seconds(0.05)
+    t.reset()
+    # Already at Imin; the interval is not restarted
+    assert t.send_time == st
+    t.set_i(10)
+    t.reset()
+    assert t.i == h.TRICKLE_IMIN
+
+def _restart(s, nodes, i, filename):
+    # Replace nodes[i] with a new instance restored from its snapshot
+    old = nodes[i]
+    pysyma.snapshot.save(old.h, filename)
+    s.nodes.remove(old)
+    node = s.add_node()
+    pysyma.snapshot.load(node.h, filename)
+    for name in ['up', 'down']:
+        ep = old.h.find_ep_by_name(name)
+        if ep is None:
+            continue
+        nep = node.ep(name)
+        assert nep.ep_id == ep.ep_id
+        for e in list(s.ep2ep[ep]):
+            if e is not ep:
+                s.set_connected(ep, e, connected=False)
+                s.set_connected(nep, e)
+    nodes[i] = node
+    return node
+
+def test_hncp_snapshot(tmpdir):
+    s, nodes = setup_tube(4)
+    nodes[0].h.add_tlv(KAInterval(ep_id=0, interval=15000))
+    s.run_until(s.is_converged, time_ceiling=30)
+    old = nodes[1].h
+    node = _restart(s, nodes, 1, str(tmpdir.join('snapshot')))
+    h = node.h
+    assert h.own_node.node_id == old.own_node.node_id
+    assert set(h.id2node) == set(old.id2node)
+    for n in old.id2node.values():
+        if n is not old.own_node:
+            assert h.id2node[n.node_id].get_node_hash() == n.get_node_hash()
+    requested = []
+    def _request_node_states(ep, src, dst, node_ids, f=h._request_node_states):
+        requested.extend(node_ids)
+        f(ep, src, dst, node_ids)
+    h._request_node_states = _request_node_states
+    s.run_until(s.is_converged, time_ceiling=10)
+    assert h.own_node.seqno > old.own_node.seqno
+    # The rest of the network was known already
+    assert not requested
+    # Garbage is rejected
+    fn = str(tmpdir.join('bad'))
+    with open(fn, 'wb') as f:
+        f.write(b'PSYS' + bytes(20))
+    with pytest.raises(ValueError):
+        pysyma.snapshot.load(DummySystem().add_node().h, fn)
+
+def test_hncp_watch():
+    s, nodes = setup_tube(3)
+    t = PadBodyTLV(t=42, body=b'foo')
+    nodes[0].h.add_tlv(t)
+    out = io.StringIO()
+    nodes[2].h.add_subscriber(pysyma.watch.WatchSubscriber(out, tlv_types=[42],
+                                                       time=nodes[2].time))
+    s.run_until(s.is_converged, time_ceiling=30)
+    def _lines():
+        l = [json.loads(x) for x in out.getvalue().splitlines()]
+        out.seek(0)
+        out.truncate()
+        return l
+    ids = [n.h.own_node.get_node_id_hex().decode() for n in nodes]
+    l = _lines()
+    assert set([x['node'] for x in l if x['event'] == 'node']) == set(ids[:2])
+    assert [(x['op'], x['node'], x['type'], x['tlv']) for x in l
+            if x['event'] == 'tlv'] == [('add', ids[0], 42,
+                                         t.encode().hex())]
+    seqno = nodes[0].h.own_node.seqno
+    assert [x['seqno'] for x in l
+            if x['event'] == 'seqno' and x['node'] == ids[0]][-1] == seqno
+    nodes[0].h.remove_tlv(t)
+    s.run_until(s.is_converged, time_ceiling=30)
+    l = _lines()
+    assert [(x['event'], x.get('op')) for x in l
+            if x['node'] == ids[0]] == [('tlv', 'remove'), ('seqno', None)]
+    assert l[-1]['old_seqno'] == seqno
+
+def test_hncp_watch_ro():
+    # As hncptool --watch: read-only, attached and then detached
+    s, nodes = setup_tube(2)
+    s.run_until(s.is_converged, time_ceiling=10)
+    node = s.add_node()
+    node.h.read_only = True
+    out = io.StringIO()
+    node.h.add_subscriber(pysyma.watch.WatchSubscriber(out, time=node.time))
+    e = node.ep('ro')
+    s.set_connected(e, nodes[1].ep('down'))
+    s.run_until(lambda: node.h.network_consistent, time_ceiling=10)
+    ids = set([n.h.own_node.get_node_id_hex().decode() for n in nodes])
+    l = [json.loads(x) for x in out.getvalue().splitlines()]
+    assert set([x['node'] for x in l if x['event'] == 'seqno']) == ids
+    s.set_connected(e, nodes[1].ep('down'), connected=False)
+    s.run_seconds(200)
+    l = [json.loads(x) for x in out.getvalue().splitlines()]
+    assert set([x['node'] for x in l
+                if x['event'] == 'node' and x['op'] == 'remove']) == ids
+
 def test_hncp_collision():
     n = 6
     s, nodes = setup_tube(n)
@@ -64,6 +323,23 @@ def test_hncp_ro():
     nodes[0].h.read_only = True
     s.run_until(s.is_converged_ro, time_ceiling=3)
 
+def test_hncp_ro_attach():
+    # Read-only node attached to (and then detached from) a network
+    for i in range(5):
+        s, nodes = setup_tube(2)
+        s.run_until(s.is_converged, time_ceiling=10)
+        node = s.add_node()
+        node.h.read_only = True
+        e = node.ep('ro')
+        s.set_connected(e, nodes[1].ep('down'))
+        s.run_until(lambda: node.h.network_consistent, time_ceiling=10)
+        assert len(list(node.h.valid_sorted_nodes())) == 2
+        _check_reachability([node])
+        s.set_connected(e, nodes[1].ep('down'), connected=False)
+        s.run_seconds(200)
+        assert not list(node.h.valid_sorted_nodes())
+        assert list(node.h.id2node.values()) == [node.h.own_node]
+
 def test_hncp_ka():
     n = 2
     s, nodes = setup_tube(n)
@@ -72,6 +348,247 @@ def test_hncp_ka():
     s.run_seconds(3)
     assert not s.is_converged()
 
+def test_hncp_packetizer():
+    s = DummySystem()
+    e = s.add_node().ep('eth0')
+    sent = []
+    e.sys_send = lambda src, dst, l: sent.append(l)
+    l = [PadBodyTLV(t=42, body=b'x' * 100) for i in range(30)]
+    e.send(None, None, l[:10])
+    e.send(None, None, l[10:])
+    e.send(None, None, [NodeStateBatch([b'%04d' % i for i in range(100)],
+                                       [1] * 100, [2] * 100,
+                                       [b'12345678'] * 100)])
+    e.packetizer.flush()
+    for p in sent:
+        assert isinstance(p[0], NodeEP)
+        assert len(encode_tlvs(*p)) <= MTU_ISH
+    assert sum([1 for p in sent for x in p if x.__class__ is PadBodyTLV]) == 30
+    assert sum([len(x) for p in sent for x in p if isinstance(x, NodeStateBatch)]) == 100
+    assert e.packetizer.sends == 3
+    assert e.packetizer.coalesced == 2
+    assert e.packetizer.packets == len(sent) == 5
+
+def test_hncp_neighbor_deadlines():
+    s, nodes = setup_tube(3)
+    s.run_until(s.is_converged, time_ceiling=30)
+    h = nodes[1].h
+    assert len(h.get_tlv_instances(Neighbor)) == 2
+    calls = []
+    def _get_neighbor_deadline(ntlv, f=h._get_neighbor_deadline):
+        calls.append(ntlv)
+        return f(ntlv)
+    h._get_neighbor_deadline = _get_neighbor_deadline
+    assert sorted(h.local_neighbors.values()) == h.get_tlv_instances(Neighbor)
+    e2 = nodes[2].ep('up')
+    ntlv = h.local_neighbors[(nodes[2].h.own_node.node_id, e2.ep_id,
+                              nodes[1].ep('down').ep_id)]
+    eptlv = NodeEP(node_id=nodes[2].h.own_node.node_id, ep_id=e2.ep_id)
+    assert h._heard(nodes[1].ep('down'), e2, None, eptlv) is ntlv
+    # Nothing is due; the neighbors are not even looked at
+    h._prune_neighbors()
+    assert calls == []
+    # KAInterval churn on the peer does not pile up heap entries
+    for i in range(50):
+        ka = nodes[2].h.add_tlv(KAInterval(ep_id=0, interval=15000))
+        s.run_seconds(1)
+        nodes[2].h.remove_tlv(ka)
+        s.run_seconds(1)
+    assert len([e for e in h.neighbor_deadlines
+                if h._is_live_neighbor_deadline(e)]) == 2
+    assert len(h.neighbor_deadlines) <= 2 * 2 + 16
+    del calls[:]
+    s.set_connected(nodes[1].ep('down'), nodes[2].ep('up'), connected=False)
+    s.run_seconds(60)
+    assert len(h.get_tlv_instances(Neighbor)) == 1
+    assert list(h.local_neighbors.values()) == h.get_tlv_instances(Neighbor)
+    assert calls
+
+class BatchSubscriber(pysyma.dncp.Subscriber):
+    subscribed_tlv_types = [PadBodyTLV]
+    def __init__(self):
+        self.calls = []
+    def tlv_events(self, n, added, removed):
+        self.calls.append((n, set(added), set(removed)))
+
+class NodeSubscriber(pysyma.dncp.Subscriber):
+    def __init__(self):
+        self.calls = []
+    def node_event(self, n, event):
+        self.calls.append((n, event))
+
+def test_hncp_subscriber_interest():
+    s, nodes = setup_tube(2)
+    s.run_until(s.is_converged, time_ceiling=30)
+    h = nodes[1].h
+    bs = BatchSubscriber()
+    ns = NodeSubscriber()
+    h.add_subscriber(bs)
+    h.add_subscriber(ns)
+    assert len(h._get_event_handlers('tlv_event')) == 2 # + DummyNode
+    assert len(h._get_event_handlers('node_event')) == 2
+    assert len(h._get_event_handlers('local_tlv_event')) == 1
+    l = [PadBodyTLV(t=42, body=b'a'), PadBodyTLV(t=42, body=b'b')]
+    for t in l:
+        nodes[0].h.add_tlv(t)
+    nodes[1].events = []
+    s.run_until(s.is_converged, time_ceiling=30)
+    n0 = h.id2node[nodes[0].h.own_node.node_id]
+    # One call with just the PadBodyTLVs, but per-TLV events to DummyNode
+    assert bs.calls == [(n0, set(l), set())]
+    assert len([x for x in nodes[1].events if x[0] == 'tlv_event']) == 2
+    assert ns.calls == []
+    nodes[0].h.remove_tlv(l[0])
+    s.run_until(s.is_converged, time_ceiling=30)
+    assert bs.calls[1:] == [(n0, set(), set(l[:1]))]
+
+def test_hncp_subscriber_queue():
+    s, nodes = setup_tube(2)
+    h = nodes[0].h
+    calls = []
+    f = lambda *a: calls.append(a)
+    q = pysyma.dncp.SubscriberQueue(h, maxlen=2)
+    n, t1, t2 = h.own_node, PadBodyTLV(t=42), PadBodyTLV(t=43)
+    q.put('tlv_event', f, (n, [t1], []))
+    q.put('tlv_event', f, (n, [t2], [t1]))
+    assert q.coalesced == 1 and len(q) == 1
+    q.put('node_event', f, (n, 1))
+    q.put('node_event', f, (n, 2)) # drops the tlv_event
+    assert q.dropped == 1 and len(q) == 2
+    assert calls == []
+    q.drain()
+    assert calls == [(n, 1), (n, 2)]
+    assert q.delivered == 2 and q.enqueued == 4
+    q.put('tlv_event', f, (n, [t1], []))
+    q.put('tlv_event', f, (n, [], [t1])) # cancel out
+    q.drain()
+    assert calls[2:] == []
+    assert q.delivered == 2 and not len(q)
+
+    # Subscriber delivery happens on a later tick
+    ns = NodeSubscriber()
+    q = h.add_subscriber(ns, queued=True, policy='drop_newest')
+    h.find_or_create_node_by_id(b'abcd')
+    assert ns.calls == [] and len(q) == 1
+    s.poll()
+    s.set_time(s.next_time())
+    s.poll()
+    assert ns.calls == [(h.id2node[b'abcd'], pysyma.dncp.NodeEvent.add)]
+    assert q.lag > 0
+
+def test_hncp_subscriber_queue_thread():
+    s, nodes = setup_tube(2)
+    h = nodes[0].h
+    ns = NodeSubscriber()
+    ns.done = threading.Event()
+    ns.node_event = lambda n, event: ns.done.set()
+    q = h.add_subscriber(ns, queued=True, thread=True)
+    h.find_or_create_node_by_id(b'abcd')
+    assert ns.done.wait(5)
+    q.close()
+    assert q.delivered == 1
+
+def test_hncp_ns_reuse():
+    s, nodes = setup_tube(2)
+    l = [PadBodyTLV(t=42, body=b'%d' % i) for i in range(20)]
+    for t in l:
+        nodes[0].h.add_tlv(t)
+    s.run_until(s.is_converged, time_ceiling=30)
+    n0 = nodes[1].h.id2node[nodes[0].h.own_node.node_id]
+    old = dict([(t.body, t) for t in n0.get_tlvs() if t.t == 42])
+    assert len(old) == 20
+    nodes[0].h.remove_tlv(l[3])
+    nodes[0].h.add_tlv(PadBodyTLV(t=42, body=b'x'))
+    nodes[1].events = []
+    s.run_until(s.is_converged, time_ceiling=30)
+    new = dict([(t.body, t) for t in n0.get_tlvs() if t.t == 42])
+    assert set(new.keys()) == set(old.keys()).difference([b'3']).union([b'x'])
+    for k, t in new.items():
+        if k != b'x':
+            assert t is old[k]
+    tlv_events = [x[1][1:] for x in nodes[1].events if x[0] == 'tlv_event']
+    assert sorted(tlv_events) == [(l[3], TLVEvent.remove),
+                                  (PadBodyTLV(t=42, body=b'x'), TLVEvent.add)]
+
+def _check_network_hash_data(nodes):
+    for node in nodes:
+        h = node.h
+        h.get_network_hash()
+        l = [struct.pack('>I', n.seqno) + n.get_node_hash()
+             for n in h.valid_sorted_nodes()]
+        assert h.network_hash_data == b''.join(l)
+
+def test_hncp_network_hash():
+    s, nodes = setup_tube(5)
+    s.run_until(s.is_converged, time_ceiling=30)
+    _check_network_hash_data(nodes)
+    nodes[2].h.add_tlv(PadBodyTLV(t=42, body=b'asd'))
+    s.run_until(s.is_converged, time_ceiling=30)
+    _check_network_hash_data(nodes)
+    # Split the tube; the halves should drop the other half's nodes
+    s.set_connected(nodes[1].ep('down'), nodes[2].ep('up'), connected=False)
+    s.run_seconds(120)
+    _check_network_hash_data(nodes)
+    assert len(nodes[0].h.network_hash_ids) == 2
+    assert len(nodes[4].h.network_hash_ids) == 3
+
+def _bidir_neighbors(h, n):
+    # Reference implementation of Node.get_bidir_neighbors
+    for t1 in n.get_tlv_instances(Neighbor):
+        n2 = h.id2node.get(t1.n_node_id)
+        if not n2: continue
+        if h.read_only and n is h.own_node:
+            # Nobody links back to a read-only node
+            yield None, n2
+            continue
+        for t2 in n2.get_tlv_instances(Neighbor):
+            if t1.ep_id == t2.n_ep_id and t1.n_ep_id == t2.ep_id and t2.n_node_id == n.node_id:
+                yield t1, n2
+
+def _check_reachability(nodes):
+    for node in nodes:
+        h = node.h
+        h._prune()
+        for n in h.id2node.values():
+            assert list(n.get_bidir_neighbors()) == list(_bidir_neighbors(h, n))
+        seen = set([h.own_node])
+        l = [h.own_node]
+        while l:
+            for t, n in _bidir_neighbors(h, l.pop()):
+                if n not in seen:
+                    seen.add(n)
+                    l.append(n)
+        assert seen == set([n for n in h.id2node.values() if n.reachable])
+        assert h.unreachable_nodes == set(h.id2node.values()).difference(seen)
+
+def test_hncp_reachability():
+    s, nodes = setup_tube(6)
+    s.run_until(s.is_converged, time_ceiling=30)
+    _check_reachability(nodes)
+    h = nodes[0].h
+    far = h.id2node[nodes[5].h.own_node.node_id]
+    ids = [node.h.own_node.node_id for node in nodes]
+    e1, e2 = nodes[2].ep('down'), nodes[3].ep('up')
+    assert h.has_bidir_link(ids[2], e1.ep_id, ids[3], e2.ep_id)
+    assert not h.has_bidir_link(ids[2], e1.ep_id, ids[4], e2.ep_id)
+    s.set_connected(nodes[2].ep('down'), nodes[3].ep('up'), connected=False)
+    s.run_seconds(50)
+    _check_reachability(nodes)
+    # Neighbors have expired, but the nodes are still in grace period
+    assert not far.reachable
+    assert not h.has_bidir_link(ids[2], e1.ep_id, ids[3], e2.ep_id)
+    assert len(h.unreachable_nodes) == 3
+    assert h.id2node[far.node_id] is far
+    assert far.last_reachable > s.start_t
+    s.set_connected(nodes[2].ep('down'), nodes[3].ep('up'))
+    s.run_until(s.is_converged, time_ceiling=30)
+    _check_reachability(nodes)
+    assert far.reachable
+    s.set_connected(nodes[2].ep('down'), nodes[3].ep('up'), connected=False)
+    s.run_seconds(120)
+    _check_reachability(nodes)
+    assert len(h.id2node) == 3
+
 def test_hncp_two():
     s = DummySystem()
     n1 = s.add_node()
@@ -19,12 +19,14 @@ Test code for SHSP
 """
 
 from net_sim import setup_tube
-from pysyma.shsp import SHSP
+from pysyma.shsp import SHSP, SHSPAuth, SHSPKV
+from pysyma.dncp_tlv import encode_tlvs
+import pysyma.snapshot
 
 SHSP.subscriber_class = None # netsim will break otherwise
 
-def _test_shsp(key=None):
-    s, nodes = setup_tube(2, proto=lambda k:SHSP(k, key=key))
+def _test_shsp(key=None, **kw):
+    s, nodes = setup_tube(2, proto=lambda k:SHSP(k, key=key, **kw))
     d = {'foo': 1, 'bar': 'baz'}
     nodes[0].h.update_dict(d)
     d0 = nodes[0].h.get_dict(printable_node=True)
@@ -62,12 +64,70 @@ def _test_shsp(key=None):
     nodes[0].h.update_dict(dict(foo='bar'))
 
 
+def test_shsp_snapshot():
+    s, nodes = setup_tube(1, proto=lambda k:SHSP(k, key=b'foo'))
+    h = nodes[0].h
+    h.update_dict(dict([('k%d' % i, i) for i in range(10)]))
+    h._flush_local()
+    at = h.own_node.get_tlv_instances(SHSPAuth)[0]
+    assert at is not h.at and at == h.at
+    old = dict([(t.json['k'], t) for t in at.tlvs])
+    h.update_dict(dict(k3='x'))
+    # Local changes do not leak to the published snapshot before flush
+    assert at != h.at
+    assert old['k3'].json['v'] == 3
+    h._flush_local()
+    nat = h.own_node.get_tlv_instances(SHSPAuth)[0]
+    assert nat == h.at and nat is not at
+    for t in nat.tlvs:
+        k = t.json['k']
+        assert (t is old[k]) == (k != 'k3')
+    assert h.own_node.get_node_data() == encode_tlvs(*h.tlvs)
+
+def test_shsp_warm_restart(tmpdir):
+    s, nodes = setup_tube(2, proto=lambda k:SHSP(k, key=b'foo'))
+    nodes[0].h.update_dict(dict(foo=1, bar='baz'))
+    s.run_until(s.is_converged, time_ceiling=3)
+    fn = str(tmpdir.join('snapshot'))
+    pysyma.snapshot.save(nodes[0].h, fn)
+    h = s.add_node().h
+    pysyma.snapshot.load(h, fn)
+    assert h.own_node.node_id == nodes[0].h.own_node.node_id
+    assert set(h.local_dict) == set(['foo', 'bar'])
+    h._flush_local()
+    assert h.own_node.seqno == nodes[0].h.own_node.seqno + 1
+    d = h.get_dict(include_timestamp=True)
+    assert d[h.own_node] == nodes[0].h.get_dict(include_timestamp=True)[nodes[0].h.own_node]
+
 def test_shsp_noauth():
     _test_shsp()
 
 def test_shsp_auth():
     _test_shsp(key=b'foo')
 
+def test_shsp_auth_blake2b():
+    _test_shsp(key=b'foo', auth_hash='blake2b', HASH_ALGORITHM='blake2b')
+    # The algorithm is per instance
+    assert SHSPAuth().algorithm == 'md5'
+    s, nodes = setup_tube(2, proto=lambda k:SHSP(k, key=b'foo'))
+    assert nodes[0].h.at.algorithm == 'md5'
+
+def test_shsp_auth_mismatch():
+    # Same key, but a different algorithm; the data is not accepted
+    protos = [lambda k:SHSP(k, key=b'foo'),
+              lambda k:SHSP(k, key=b'foo', auth_hash='blake2b')]
+    s, nodes = setup_tube(2, proto=lambda k:protos.pop(0)(k))
+    nodes[1].h.update_dict(dict(foo=1))
+    s.run_until(s.is_converged, time_ceiling=3)
+    assert nodes[0].h.get_dict() == {}
+    assert list(nodes[1].h.get_dict().values()) == [dict(foo=1)]
+    # Nor is it visible in the node (to e.g. other subscribers)
+    n = nodes[0].h.id2node[nodes[1].h.own_node.node_id]
+    assert n.get_tlv_instances(SHSPAuth)
+    assert not [t for at in n.get_tlv_instances(SHSPAuth)
+                for t in at.get_tlv_instances(SHSPKV)]
+    assert n.get_node_hash() == nodes[1].h.own_node.get_node_hash()
+
 if __name__ == '__main__':
     import logging
     logging.basicConfig(level=logging.DEBUG)
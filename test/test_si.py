@@ -19,6 +19,8 @@ HNCP-ish protocol with per-endpoint transport.
 
 """
 
+import socket
+import time
 import unittest
 
 import pysyma.dncp
@@ -40,6 +42,10 @@ class HastyHNCP(pysyma.dncp.HNCP):
     TRICKLE_IMIN = 0.02
 
 
+class HastyBatchHNCP(HastyHNCP):
+    BATCH_NODE_STATES = True
+
+
 class HNCPTests(unittest.TestCase):
 
     def setUp(self):
@@ -74,6 +80,16 @@ class HNCPTests(unittest.TestCase):
         s2.set_dncp_unicast_listen(h2)
         self._wait_in_sync(h2, h1)
 
+    def test_si_batch(self):
+        s1 = self.si.create_socket(port=0)
+        s2 = self.si.create_socket(port=next(port_source))
+        h1 = HastyBatchHNCP(sys=s1)
+        h1.add_tlv(pysyma.dncp_tlv.PadBodyTLV(t=42, body=b'asd'))
+        h2 = HastyBatchHNCP(sys=s2)
+        s1.set_dncp_unicast_connect(h1, ('::1', s2.get_port()))
+        s2.set_dncp_unicast_listen(h2)
+        self._wait_in_sync(h2, h1)
+
     def test_si2(self):
         s1 = self.si.create_socket(port=0)
         s2 = self.si.create_socket(port=next(port_source))
@@ -84,6 +100,76 @@ class HNCPTests(unittest.TestCase):
         s2.set_dncp_multicast(h2, [], unicast_ep_name='unicast-listen')
         self._wait_in_sync(h2, h1)
 
+    def test_si_handoff(self):
+        s1 = self.si.create_socket(port=0)
+        s2 = self.si.create_socket(port=next(port_source))
+        h1 = HastyHNCP(sys=s1)
+        h1.add_tlv(pysyma.dncp_tlv.PadBodyTLV(t=42, body=b'asd'))
+        h2 = HastyHNCP(sys=s2)
+        h2.add_tlv(pysyma.dncp_tlv.PadBodyTLV(t=42, body=b'foo'))
+        s1.set_dncp_unicast_connect(h1, ('::1', s2.get_port()))
+        s2.set_dncp_unicast_listen(h2)
+        self._wait_in_sync(h2, h1)
+        neighbors = h1.get_tlv_instances(pysyma.dncp_tlv.Neighbor)
+        seqno = h1.id2node[h2.own_node.node_id].seqno
+        # Hand the listening side over; it gets the same socket, so
+        # h1 does not notice anything
+        c1, c2 = socket.socketpair()
+        acked = []
+        self.si.handoff(c1, [s2], cb=acked.append)
+        assert s2.paused
+        h3, = self.si.takeover(c2, HastyHNCP)
+        assert h3.own_node.node_id == h2.own_node.node_id
+        assert h3.own_node.seqno == seqno
+        n3 = h3.get_tlv_instances(pysyma.dncp_tlv.Neighbor)
+        assert n3 == h2.get_tlv_instances(pysyma.dncp_tlv.Neighbor)
+        assert n3[0].trickle.addrs == h2.get_tlv_instances(
+            pysyma.dncp_tlv.Neighbor)[0].trickle.addrs
+        last_contact = n3[0].last_contact
+        # (The _wait_in_sync subscribers may stop the loop early)
+        et = time.time() + 1
+        while time.time() < et:
+            self.si.loop(max_duration=et - time.time())
+        assert n3[0].last_contact > last_contact
+        # The ack closed the old socket, and disabled its endpoints
+        assert acked == [True]
+        assert s1 in self.si.sockets and s2 not in self.si.sockets
+        assert not [ep for ep in h2.id2ep.values() if ep.enabled]
+        assert [ep for ep in h1.id2ep.values() if ep.enabled]
+        assert h1.get_tlv_instances(pysyma.dncp_tlv.Neighbor) == neighbors
+        assert h1.id2node[h3.own_node.node_id].seqno == seqno
+        assert h3.own_node.seqno == seqno
+        assert h3.get_network_hash() == h1.get_network_hash()
+
+    def test_si_handoff_failed(self):
+        s1 = self.si.create_socket(port=0)
+        s2 = self.si.create_socket(port=next(port_source))
+        h1 = HastyHNCP(sys=s1)
+        h2 = HastyHNCP(sys=s2)
+        s1.set_dncp_unicast_connect(h1, ('::1', s2.get_port()))
+        s2.set_dncp_unicast_listen(h2)
+        self._wait_in_sync(h2, h1)
+        c1, c2 = socket.socketpair()
+        acked = []
+        self.si.handoff(c1, [s2], cb=acked.append)
+
+        class BrokenHNCP(HastyHNCP):
+            def __init__(self, **kw):
+                raise ValueError('broken')
+        self.assertRaises(ValueError, self.si.takeover, c2, BrokenHNCP)
+        # The successor gives up; the old socket is used again
+        c2.close()
+        assert self.si.sockets == [s1, s2]
+        self.si.loop(max_duration=0.1)
+        assert acked == [False]
+        assert not s2.paused
+        assert [ep for ep in h2.id2ep.values() if ep.enabled]
+        t = h2.add_tlv(pysyma.dncp_tlv.PadBodyTLV(t=42, body=b'foo'))
+        et = time.time() + 1
+        while time.time() < et:
+            self.si.loop(max_duration=et - time.time())
+        assert t in h1.id2node[h2.own_node.node_id].tlvs
+
     def test_si3(self):
         h1 = self.si.create_dncp(HastyHNCP)
         h1.add_tlv(pysyma.dncp_tlv.PadBodyTLV(t=42, body=b'asd'))